@@ -1,7 +1,29 @@
+import array	#compact row offsets for the file reader
+import collections	#deques for tracking in-flight work
+import concurrent.futures	#thread pools for concurrent updates
+import contextlib	#timing stages
+import csv		#quoting output fields
+import datetime	#dates for the daily call budget
+import functools	#caching parsed descriptions
+import hashlib	#recognising titles that haven't changed
+import heapq	#merging sorted runs when splitting
+import io		#parsing quoted rows
+import itertools	#chaining row streams
+import json		#writing the metrics report
+import locale	#the system's default file encoding
+import mmap		#memory-mapping input files
+import email.utils	#parsing Retry-After dates
 import os		#operating system stuff
+import pickle	#spilling sorted runs to disk
+import queue	#handing rows between pipeline stages
+import random	#jitter for retry backoff
 import re		#regular expressions
+import signal	#stopping --watch mode cleanly
+import sqlite3	#the local item cache
 import requests #simplifies network calls.  #http://docs.python-requests.org
 import sys 		#interpreter functions and variables
+import tempfile	#files for sorted runs
+import threading	#locks shared between update workers
 import time		#for timing processes
 import xml.etree.ElementTree as ET	#handling xml data from Alma
 
@@ -11,6 +33,140 @@ import xml.etree.ElementTree as ET	#handling xml data from Alma
 sandbox_apikey = '####################################'
 active_apikey = '####################################'
 
+# The Alma API that items are fetched from and pushed to. Point this at a
+# local stand-in such as MockAlma.py (e.g. --api-url=http://localhost:8080/almaws/v1)
+# to try out or benchmark updates without using real API calls.
+alma_api_url = 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1'
+
+# The number of items update() works on at once. Every worker shares the same
+# pool of keep-alive connections to Alma, so a run spends its time waiting on
+# several requests in parallel rather than one round-trip after another.
+update_workers = 8
+
+# Alma limits how fast and how often its APIs may be called. Every request
+# update() makes is kept under requests_per_second, and no more than
+# daily_call_budget requests are made in a day (None for no limit). Responses
+# with a code in retry_statuses are retried up to max_retries times, waiting
+# roughly retry_backoff seconds before the first retry and twice as long
+# before each one after; only the worker whose request failed waits. A 429,
+# or a Retry-After sent by Alma (which is always honored), holds back every
+# worker.
+requests_per_second = 25
+daily_call_budget = None
+
+# How many requests have been made each day is kept in call_count_file, so
+# the daily budget covers every run on the same day (and runs going at the
+# same time) rather than each run on its own. None keeps the count in memory,
+# which makes daily_call_budget a limit on each run instead.
+call_count_file = 'call_count.sqlite'
+max_retries = 5
+retry_backoff = 1.0
+retry_statuses = (429, 500, 502, 503, 504)
+
+# No request waits more than connect_timeout seconds to connect to Alma, or
+# read_timeout seconds for Alma to send something back; a request that does
+# is retried like any other failed request. When hedge_percentile is set
+# (e.g. 95), a GET still unanswered after that percentile of the latest
+# hedge_window GET times is sent a second time, and whichever answer comes
+# first is used. PUTs are never sent twice. Hedging waits for
+# hedge_min_samples GETs before it starts, and the extra GETs count against
+# the limits above.
+connect_timeout = 10.0
+read_timeout = 60.0
+hedge_percentile = None
+hedge_min_samples = 20
+hedge_window = 1000
+
+# Items fetched from Alma can be kept in a local SQLite cache (e.g. pass
+# --cache=item_cache.sqlite), so that prefetches (-p) and re-runs of err_
+# files don't fetch them again. The cache is off (None) unless a file is
+# given. Cached items older than item_cache_ttl seconds are fetched again,
+# and once the cache holds more than item_cache_size items the least
+# recently used are dropped. An item is removed from the cache as soon as it
+# is updated.
+# NOTE: update() edits the cached copy of an item and PUTs the whole record
+# back, so anything changed in Alma since the item was cached is overwritten,
+# and an item whose cached copy already matches is left as it is. Only use
+# the cache when nobody else is editing the items, and keep the TTL short.
+item_cache_file = None
+item_cache_ttl = 60*60
+item_cache_size = 200000
+
+# Files with more than split_parallel_rows items are split using
+# split_processes processes at once, each working on different titles.
+split_processes = os.cpu_count() or 1
+split_parallel_rows = 50000
+
+# Files too big to sort in memory can be split split_run_rows items at a time
+# instead: each batch is sorted and set aside in a temporary file, and the
+# batches are merged back together at the end. None sorts the whole file in
+# memory (which is quicker, and can use several processes).
+split_run_rows = None
+
+# Splitting a file again (e.g. after fixing a few descriptions) only splits
+# the titles whose rows have changed since; the rest are taken from
+# split_cache_file, which keeps the split rows of up to split_cache_size
+# titles. A title's rows are recognised by their contents once defaults are
+# filled in, and the whole cache is left behind whenever this program
+# changes. Set split_cache_file to None (or pass --split-cache=) to turn it
+# off. Files sorted in runs (split_run_rows) don't use it.
+split_cache_file = 'split_cache.sqlite'
+split_cache_size = 200000
+
+# In --watch mode, how many seconds apart the folder is checked for new files.
+watch_interval = 2.0
+
+# The most rows that can be waiting between two stages in --pipeline mode.
+pipeline_queue_size = 1000
+
+# Before updating, every row is checked for problems that would make it fail
+# (see _validateTable), so none of them are sent. When rows are streamed in
+# (--pipeline), they are checked validation_chunk_size at a time instead.
+validation_chunk_size = 1000
+
+# The text encoding of the CSV files read and written. This defaults to the
+# system's own, which is what spreadsheet programs usually save CSV files in.
+csv_encoding = locale.getpreferredencoding(False)
+
+# Output files are written through a buffer of output_buffer_size bytes,
+# which is flushed to disk at least every output_flush_interval seconds.
+output_buffer_size = 1024*1024
+output_flush_interval = 5.0
+
+# While working through a file, progress (items done, how fast, and how long
+# is left) is shown every progress_interval seconds. Setting quiet to True
+# (or passing --quiet) turns it off, e.g. for runs from cron.
+progress_interval = 1.0
+quiet = False
+
+# Every run writes a report of where its time went (per stage, and for
+# each request to Alma) to 'met_inputfile.json'. Set to False to turn it off.
+metrics_report = True
+
+# Columns whose values repeat from item to item (every copy of a title shares
+# its MMS ID, for instance). Only one copy of each distinct value in these
+# columns is kept in memory while a file is worked on.
+interned_columns = ('MMS ID', 'Material Type', 'Item Policy')
+
+# Settings above that can be overridden from the command line with a
+# --name=value flag, as flag: (setting, type) pairs.
+options = {'--workers': ('update_workers', int),
+		   '--rate': ('requests_per_second', float),
+		   '--budget': ('daily_call_budget', int),
+		   '--call-count': ('call_count_file', str),
+		   '--retries': ('max_retries', int),
+		   '--cache': ('item_cache_file', str),
+		   '--cache-ttl': ('item_cache_ttl', float),
+		   '--processes': ('split_processes', int),
+		   '--sort-runs': ('split_run_rows', int),
+		   '--split-cache': ('split_cache_file', str),
+		   '--api-url': ('alma_api_url', str),
+		   '--progress': ('progress_interval', float),
+		   '--connect-timeout': ('connect_timeout', float),
+		   '--read-timeout': ('read_timeout', float),
+		   '--hedge': ('hedge_percentile', float),
+		   '--watch-interval': ('watch_interval', float)}
+
 # Tuples designate the column name, flags indicating how to process the
 # item, and optionally what the default value of items should be when
 # being updated. If the flags contain an 'n', it means the field contains
@@ -76,6 +232,17 @@ code_tables = {'Status':{
 					'Requested': 'REQUESTED',
 					'In Transit to Remote Storage': 'TRANSIT_TO_REMOTE_STORAGE'}}
 
+# The fields of an Alma item (under item_data) that each column is written
+# to when updating, in the order changes are noted. Blank values leave
+# Alma's field as it is. A column with a code table is written as the value's
+# code, with the value itself kept as the field's 'desc', as Alma does.
+item_fields = [('Material Type', 'physical_material_type'),
+			   ('Item Policy', 'policy'),
+			   ('Enum A', 'enumeration_a'),
+			   ('Enum B', 'enumeration_b'),
+			   ('Chron I', 'chronology_i'),
+			   ('Chron J', 'chronology_j')]
+
 """ main()
 	The function main() pulls out the arguments passed through the command
 	prompt and determines which functionality to execute based on flags.  This
@@ -90,6 +257,51 @@ code_tables = {'Status':{
 		extract its information.
 		3) -u(pdate): takes a csv file and will push the each item's
 		information back into Alma according to the the 
+		4) -p(refetch): takes a csv file and fetches every item that -u would
+		update into the local item cache, so a later -u only has to spend
+		requests on pushing changes.
+		
+		Options given as --name=value override the settings at the top of
+		this file:
+			--workers=N: how many items -u sends to Alma at once.
+			--rate=N: the most requests -u makes per second.
+			--budget=N: the most requests made in a day, counting every
+			run that day.
+			--call-count=FILE: the file the day's requests are counted in
+			(empty to count each run on its own).
+			--retries=N: how many times a failed request is retried.
+			--cache=FILE: keep fetched items in this cache file (off by
+			default; -u then sends back the cached records).
+			--cache-ttl=N: how many seconds a cached item is kept.
+			--processes=N: how many processes -s uses on large files.
+			--sort-runs=N: sort the file N items at a time in temporary
+			files when using -s, for files too big to fit in memory.
+			--split-cache=FILE: the file -s keeps already split titles in
+			(empty to turn it off).
+			--api-url=URL: the Alma API to use, e.g. a local MockAlma.py.
+			--progress=N: how many seconds apart progress is shown.
+			--connect-timeout=N, --read-timeout=N: how many seconds a
+			request may wait to connect, and for Alma to answer.
+			--hedge=P: send a GET again if it's slower than the P'th
+			percentile of GETs so far, using whichever answer comes first.
+		Adding --quiet turns off the progress display.
+		
+		-u also keeps a journal ('jrn_inputfile') of the items it has finished.
+		If a run is interrupted, adding --resume skips the items the journal
+		shows were already updated.
+		
+		Adding --pipeline to -u along with -f and/or -s runs the stages side by
+		side, passing items from one to the next in memory: updating starts on
+		the first titles while later ones are still being split. The 'f_' and
+		's_' files are only written if --keep is also given. In this mode
+		items are only sorted within each title, and titles are kept in the
+		order they appear in the input file (rows for a title should be kept
+		together).
+		
+		With --watch, inputCSVorTXT is a folder instead, and the program keeps
+		running, putting each file dropped into the folder through the steps
+		given (see watch()). --watch-interval=N sets how many seconds apart
+		the folder is checked.
 		   
 		 ******************************* WARNING *******************************
 		 *   This program heavily relies on the CSV format, which depends on   *
@@ -113,28 +325,156 @@ code_tables = {'Status':{
 """
 def main():	
 	if len(sys.argv) < 3:
-		print("usage: BatchUpdate.py inputCSVorTXT {-f|-s|-u}")
+		print("usage: BatchUpdate.py inputCSVorTXT {-f|-s|-p|-u} [--resume] [--pipeline [--keep]] [--quiet] [--option=value]")
+		print("       BatchUpdate.py folder --watch {-f|-s|-p|-u} [...]")
 		sys.exit(1)
 	
 	filename = sys.argv[1]
 	flags = sys.argv[2:]
+	_applyOptions(flags)
+	if '--quiet' in flags:
+		globals()['quiet'] = True
+	
+	if '--watch' in flags:
+		watch(filename, flags)
+		return
+	
+	try:
+		_run(filename, flags)
+	finally:
+		_saveReport(filename, flags)
+
+"""_run(filename, flags, shared=None, confirmed=False)
+		Runs the steps asked for by the command line flags on a file. Updating
+		straight after formatting or splitting asks for confirmation first,
+		unless it was already given. 'shared' is the UpdateWorkers for -p and
+		-u to use, if they shouldn't set up their own.
+"""
+def _run(filename, flags, shared=None, confirmed=False):
+	
+	# Pipeline mode runs -f and/or -s together with -u in one go, without
+	# reading and writing the files in between.
+	if ('--pipeline' in flags) and ('-u' in flags) and (('-f' in flags) or ('-s' in flags)):
+		if not confirmed:
+			_confirmUpdate()
+		pipeline(filename, '-f' in flags, '-s' in flags, '--keep' in flags, '--resume' in flags, shared)
+		return
 	
 	if '-f' in flags:
 		filename = format(filename)
 	if '-s' in flags:
 		filename = split(filename)
+	if '-p' in flags:
+		prefetch(filename, shared)
 	if '-u' in flags:
-		if ('-f' in flags) or ('-s' in flags):
-			text = str(input("Are you sure you want to update without reviewing the data? (Y/N) "))
-			print(text.upper())
-			if text.upper() != 'Y':
-				print("Halting processes")
-				sys.exit(1)
-		filename = update(filename)
-	if ('-f' not in flags) and ('-s' not in flags) and ('-u' not in flags):
-		print("usage: BatchUpdate.py inputCSV {-f|-s|-u}")
+		if (('-f' in flags) or ('-s' in flags)) and not confirmed:
+			_confirmUpdate()
+		filename = update(filename, '--resume' in flags, shared)
+	if ('-f' not in flags) and ('-s' not in flags) and ('-p' not in flags) and ('-u' not in flags):
+		print("usage: BatchUpdate.py inputCSV {-f|-s|-p|-u}")
+		sys.exit(1)
+
+# Makes sure the user means to update without looking over the formatted or
+# split file first, stopping the program if not.
+def _confirmUpdate():
+	text = str(input("Are you sure you want to update without reviewing the data? (Y/N) "))
+	print(text.upper())
+	if text.upper() != 'Y':
+		print("Halting processes")
+		sys.exit(1)
+
+# Writes the metrics report for a run on 'filename', if there is anything
+# to report (see metrics_report).
+def _saveReport(filename, flags):
+	if metrics_report and metrics.stages:
+		report_filename = os.path.splitext(_outputName('met_', filename))[0] + '.json'
+		metrics.save(report_filename, filename, flags)
+		print("Metrics written to " + report_filename)
+
+"""watch(folder, flags)
+		Keeps running until stopped (with Ctrl+C or SIGTERM), putting every
+		CSV or TXT file dropped into 'folder' through the steps given by
+		flags, one file at a time in the order they arrive. A file is picked
+		up once its size has stopped changing, and moved into the folder's
+		'processed' folder, where its output files and metrics report are
+		written as well. If a file fails, the problem is printed and the next
+		file is carried on with.
+		Everything that takes time to set up is only set up once and used for
+		every file: the description patterns and caches, the Alma client (with
+		its connections, item cache and request limits) and the update
+		workers. Anything that would be asked (e.g. whether to update without
+		reviewing the data) is asked once, before the first file.
+"""
+def watch(folder, flags):
+	global metrics
+	
+	if ('-f' not in flags) and ('-s' not in flags) and ('-p' not in flags) and ('-u' not in flags):
+		print("usage: BatchUpdate.py folder --watch {-f|-s|-p|-u}")
 		sys.exit(1)
+	if ('-u' in flags) and (('-f' in flags) or ('-s' in flags)):
+		_confirmUpdate()
+	
+	done_folder = os.path.join(folder, 'processed')
+	os.makedirs(done_folder, exist_ok=True)
+	signal.signal(signal.SIGTERM, signal.default_int_handler)
+	shared = UpdateWorkers(update_workers)
+	print("Watching " + folder + " for files (Ctrl+C to stop)...")
+	
+	# The size and modification time each file had when last seen. Files
+	# that are still being written are left until they stop changing. A file
+	# that is renamed or removed while being looked at (such as an upload
+	# being given its final name) is left for the next check.
+	seen = {}
+	try:
+		while True:
+			waiting = {}
+			for entry in os.scandir(folder):
+				if entry.name.startswith('.') or not entry.name.lower().endswith(('.csv', '.txt')):
+					continue
+				try:
+					if entry.is_file():
+						stat = entry.stat()
+						waiting[entry.path] = (stat.st_size, stat.st_mtime)
+				except OSError:
+					pass
+			ready = sorted((path for path in waiting if seen.get(path) == waiting[path]), key=lambda path: waiting[path][1])
+			seen = waiting
+			
+			for path in ready:
+				filename = os.path.join(done_folder, os.path.basename(path))
+				del seen[path]
+				try:
+					os.replace(path, filename)
+				except OSError:
+					continue
+				
+				metrics = Metrics()
+				try:
+					_run(filename, flags, shared, confirmed=True)
+				except KeyboardInterrupt:
+					raise
+				except BaseException as e:
+					print("Could not finish " + filename + ": " + (type(e).__name__ + " " + str(e)).strip())
+				finally:
+					_saveReport(filename, flags)
+				print("Done with " + filename + "\n")
+			time.sleep(watch_interval)
+	except KeyboardInterrupt:
+		print("Stopped watching " + folder)
+	finally:
+		shared.close()
 		
+"""_applyOptions(flags)
+		Overrides settings at the top of this file with any command line flags
+		in the form --name=value (see 'options').
+"""
+def _applyOptions(flags):
+	for flag in flags:
+		name, sep, value = flag.partition('=')
+		if sep and (name in options):
+			setting, kind = options[name]
+			globals()[setting] = kind(value)
+	
 """ format()
 		-takes a csv file of items pulled out of Alma, and removes all
 		extraneous information.  The input csv should be preformatted to not
@@ -143,36 +483,59 @@ def main():
 """	
 def format(filename):
 	print("Formatting "+filename+"...")
-	output = []
-	data = _readFile(filename)
-	
 	
-	# Add columns to the original data that need to be present, retrieve indexes
-	# for referencing, and record special columns needing formatting.
-	(data,ind,nums,derived) = _checkColumns(data,mand,opt,add)
-
-	for row in data:
-		item = []
-		# Check every column recorded within the _checkColumns function.
-		for col in ind:
-		
-			# Prepend a "'" if the column is numerical.  This prevents a bug in
-			# CSV data which can lossily save over large numbers that it
-			# reinterprets in scientific notation
-			#     ( 11719123456789 -> 1.171E13 -> 11710000000000 )
-			# Check whether the column is a number that needs special handling.
-			# Ignore the first row. It shouldn't need special handling.
-			if (col in nums) and (data.index(row)>0):
-				item.append("'" + row[ind[col]])
-			else:
-				item.append(row[ind[col]])
-				
-		output.append(item)
-
+	# Rows are streamed straight from the input file to the output file one
+	# at a time, so memory use doesn't grow with the size of the file.
 	# Write to a new file using the provided filename with a prefix.
-	# Checks for and eliminates already attached prefixes 
-	new_filename = _writeTo('f_', output)
-	return new_filename
+	# Checks for and eliminates already attached prefixes. The input is
+	# opened and its header checked before the output file is created, so a
+	# bad input doesn't leave an empty file behind.
+	with metrics.stage('format'):
+		rows = _formatStream(MappedCsv(filename))
+		output = CsvOutput('f_', filename)
+		output.writeRows(rows)
+		output.close()
+	metrics.addRows('format', output.rows - 1)
+	return output.filename
+
+"""_formatStream(reader)
+		Formats the rows of a MappedCsv, returning them as a stream (header
+		first). The header is dealt with straight away, the rest of the rows as
+		they are asked for. Only the fields of the columns being kept are ever
+		read out of the file.
+"""
+def _formatStream(reader):
+	header = reader[0]
+	
+	# Add columns to the original header that need to be present, retrieve
+	# indexes for referencing, and record special columns needing formatting.
+	# Columns added here come after all of the file's own columns, so rows
+	# simply have nothing at those indexes.
+	with metrics.stage('check_columns'):
+		(header_data,ind,nums,derived) = _checkColumns([header],mand,opt,add)
+	
+	# Work out once which columns to keep, and whether each is numerical.
+	# Prepend a "'" if the column is numerical.  This prevents a bug in
+	# CSV data which can lossily save over large numbers that it
+	# reinterprets in scientific notation
+	#     ( 11719123456789 -> 1.171E13 -> 11710000000000 )
+	projection = [(ind[col], col in nums) for col in ind]
+	
+	columns = [i for (i, numeric) in projection]
+	numeric = [j for j in range(len(projection)) if projection[j][1]]
+	
+	def project():
+		# The header row shouldn't need special handling.
+		yield [header_data[0][i] for i in columns]
+		progress = Progress("Formatting", len(reader) - 1, every=1000)
+		for row in reader.iterRows(1, columns):
+			for j in numeric:
+				row[j] = "'" + row[j]
+			yield row
+			progress.advance()
+		progress.close()
+		reader.close()
+	return project()
 	
 """split()
 		- Takes a list of items and pass each through a series of regular
@@ -191,25 +554,103 @@ def split(filename):
 	print("Splitting "+filename+"...")
 	
 	
-	# Read the file into useable data
-	data = _readFile(filename)
+	# Read the file into useable data, adding columns that need to be present
+	# and filling in defaults.
+	rows = _iterFile(filename)
+	with metrics.stage('check_columns'):
+		(header, ind, fills) = _prepareSplit(next(rows))
+	
+	# Files too big for memory are sorted in runs (reporting on the
+	# descriptions themselves once they're done).
+	if split_run_rows:
+		rows = _splitExternal(rows, header, ind, fills, split_run_rows)
+		with metrics.stage('write'):
+			new_filename = _writeTo('s_', filename, itertools.chain([header], rows))
+		return new_filename
+	
+	with metrics.stage('read'):
+		table = ItemTable(header, rows)
+	metrics.addRows('read', len(table))
+	with metrics.stage('fill_defaults', len(table)):
+		_fillDefaults(table, fills)
+	
+	# Everything from here on (parsing, sorting and the tests) only ever
+	# looks at one title (MMS ID) at a time, so large files are shared out
+	# between several processes by title.
+	progress = Progress("Splitting", len(table), every=1000)
+	if split_cache_file:
+		(table, no_match_count, hits, misses, reused) = _splitCached(table, ind, progress)
+	else:
+		(table, no_match_count, hits, misses) = _splitAll(table, ind, progress)
+	progress.close()
+	
+	if 'Description' in ind:
+		_reportMatches(no_match_count, hits, misses)
+	if split_cache_file:
+		print("Split cache: " + str(reused[0]) + " of " + str(reused[1]) + " titles unchanged")
+			
+	# Write to a new csv file using the provided filename with a prefix
+	# Check for and eliminate already attached prefixes	
+	with metrics.stage('write', len(table)):
+		new_filename = _writeTo('s_', filename, itertools.chain([table.header], table.rowLists()))
+	return new_filename
+
+"""_splitStream(rows)
+		Splits a stream of rows (header first), returning the split stream.
+		Rows are handled a title (MMS ID) at a time as soon as all of the
+		title's rows have arrived, so each title is only sorted within itself
+		and titles come out in the order they went in. Any prompting for
+		defaults happens straight away, the rest as rows are asked for.
+"""
+def _splitStream(rows):
+	(header, ind, fills) = _prepareSplit(next(rows))
+	
+	def run():
+		yield header
+		no_match_count = hits = misses = 0
+		group = []
+		for row in itertools.chain(rows, [None]):
+			# A new title (or the end of the file) finishes off the last one.
+			if group and ((row == None) or (row[ind["MMS ID"]] != group[0][ind["MMS ID"]])):
+				table = ItemTable(header, group)
+				_fillDefaults(table, fills)
+				result = _splitTable(table, ind)
+				no_match_count += result[1]
+				hits += result[2]
+				misses += result[3]
+				for done in result[0].rowLists():
+					yield done
+				group = []
+			if row != None:
+				group.append(row)
+		
+		if 'Description' in ind:
+			_reportMatches(no_match_count, hits, misses)
+	return run()
+
+"""_prepareSplit(header)
+		Works out everything split() needs to know from the header: adds the
+		columns that need to be present and fetches the values that the
+		optional and add-in columns should be filled in with, prompting the user
+		where needed. Returns the new header, the column indexes and a list of
+		(index, value, only blanks) fills for _fillDefaults.
+"""
+def _prepareSplit(header):
 	
 	# Add columns to the data that need to be present, retrieve indexes
 	# for referencing, and record columns with formatting.
-	(data, ind, num, derived) = _checkColumns(data, mand, opt, add)
+	(data, ind, num, derived) = _checkColumns([header], mand, opt, add)
 	
 	# Always add the "Pattern" and "Notes" columns if they aren't present.
-	if "Pattern" not in data[0]:
-		for row in data:
-			row.append("")
-		data[0][-1] = "Pattern"
-	ind["Pattern"] = data[0].index("Pattern")
-	
-	if "Notes" not in data[0]:
-		for row in data:
-			row.append("")
-		data[0][-1] = "Notes"
-	ind["Notes"] = data[0].index("Notes")
+	if "Pattern" not in header:
+		header.append("Pattern")
+	ind["Pattern"] = header.index("Pattern")
+	
+	if "Notes" not in header:
+		header.append("Notes")
+	ind["Notes"] = header.index("Notes")
+	
+	fills = []
 	
 	# For optional columns present in the data, fetch a value to overwrite all
 	# **blank** entries with. When a default was given, use that, otherwise
@@ -217,7 +658,7 @@ def split(filename):
 	# Also will ignore any column with the 'x' ignore flag.
 	for opt_col in opt:
 		opt_colname = opt_col[0]
-		if (opt_colname in data[0]) and ('x' not in opt_col[1]):
+		if (opt_colname in header) and ('x' not in opt_col[1]):
 			
 			message = "How should '" + opt_colname + "' be filled in?  *blank* --> "
 			
@@ -233,10 +674,7 @@ def split(filename):
 				#   option is found. Update all blank values with the
 				#   replacement.
 				replacement = _checkValue(opt_colname, replacement, message)
-					
-				for row in data[1:]:
-					if row[ind[opt_colname]] == "":
-						row[ind[opt_colname]] = replacement
+				fills.append((ind[opt_colname], replacement, True))
 	
 	# For the add-in columns, fetch a value to overwrite **all entries** with.
 	# When a default was given, use that, otherwise prompt the user for a value.
@@ -259,313 +697,1565 @@ def split(filename):
 				#-> Check replacement against possible values until a valid
 				#   option is found. Update all values with the replacement.
 				replacement = _checkValue(add_colname, replacement, message)
-				
-				for row in data[1:]:
-					row[ind[add_colname]] = replacement
+				fills.append((ind[add_colname], replacement, False))
+	
+	return (header, ind, fills)
+
+# Fills in the default values worked out by _prepareSplit, a whole column at
+# a time.
+def _fillDefaults(table, fills):
+	for (i, replacement, only_blanks) in fills:
+		column = table.columns[i]
+		if only_blanks:
+			column[:] = [(value, replacement)[value == ""] for value in column]
+		else:
+			column[:] = [replacement] * len(column)
+	
+# Splits a table in one process, or in several if it is big enough to be
+# worth it. Returns the same as _splitTable.
+def _splitAll(table, ind, progress=None):
+	if (split_processes > 1) and (len(table) > split_parallel_rows):
+		return _splitParallel(table, ind, split_processes, progress)
+	return _splitTable(table, ind, progress)
+
+"""_splitCached(table, ind, progress=None)
+		Does the same as _splitAll, but only splits the titles (MMS IDs) that
+		aren't in the split cache, taking the others' split rows from it. As
+		nothing done to a title depends on any other title, putting the titles
+		back together in sorted order gives the same rows as splitting the
+		whole table. The newly split titles are added to the cache. Returns
+		what _splitAll does, plus how many titles were found in the cache out
+		of how many.
+"""
+def _splitCached(table, ind, progress=None):
+	cache = SplitCache(split_cache_file, split_cache_size)
+	try:
+		with metrics.stage('split_cache', len(table)):
+			(titles, keys) = _titleKeys(table, ind)
+			found = cache.getMany(keys.values())
+		
+		changed = [mms_id for mms_id in sorted(titles) if keys[mms_id] not in found]
+		if progress != None:
+			progress.advance(len(table) - sum(len(titles[mms_id]) for mms_id in changed), status='unchanged')
+		(done, no_match_count, hits, misses) = _splitAll(table.take([i for mms_id in changed for i in titles[mms_id]]), ind, progress)
+		
+		# The split rows of each changed title, which come out of _splitAll
+		# in the same order as 'changed'.
+		split_rows = {}
+		start = 0
+		for mms_id in changed:
+			end = start + len(titles[mms_id])
+			split_rows[keys[mms_id]] = list(zip(*[column[start:end] for column in done.columns]))
+			start = end
+		done = None
+		with metrics.stage('split_cache'):
+			cache.putMany(split_rows.items())
+	finally:
+		cache.close()
+	
+	split_rows.update(found)
+	with metrics.stage('split_cache'):
+		table = ItemTable(table.header, itertools.chain.from_iterable(split_rows[keys[mms_id]] for mms_id in sorted(titles)))
 	
-	# If the 'Description' field is present in the index list, run the
-	# enumeration and chronology parser.
+	# Descriptions that couldn't be parsed are counted for the whole table,
+	# including the titles that weren't split this time. The patterns of
+	# those titles weren't counted either, so they are taken from their
+	# cached rows.
 	if 'Description' in ind:
-		data = _matchDescriptions(data,ind)
+		no_match_count = table.columns[ind["Pattern"]].count("N/A")
+		metrics.addPatterns(row[ind["Pattern"]] for mms_id in titles if keys[mms_id] in found for row in found[keys[mms_id]])
+	return (table, no_match_count, hits, misses, (len(titles) - len(changed), len(titles)))
+
+# Groups a table's rows by title, and works out the split cache key of each
+# title: a hash of the title's rows in file order, along with the header and
+# this program (a change to either could change how the rows are split).
+# Returns the row indexes of each title and the keys, both by MMS ID.
+def _titleKeys(table, ind):
+	with open(__file__, 'rb') as program:
+		base = hashlib.sha1(program.read())
+	base.update("\x1f".join(table.header).encode('utf-8', 'surrogatepass'))
+	
+	titles = {}
+	hashes = {}
+	mms = ind["MMS ID"]
+	for start in range(0, len(table), 10000):
+		rows = zip(*[column[start:start+10000] for column in table.columns])
+		for (i, row) in enumerate(rows, start):
+			mms_id = row[mms]
+			if mms_id not in titles:
+				titles[mms_id] = []
+				hashes[mms_id] = base.copy()
+			titles[mms_id].append(i)
+			hashes[mms_id].update(("\x1e" + "\x1f".join(row)).encode('utf-8', 'surrogatepass'))
+	return (titles, {mms_id: digest.hexdigest() for (mms_id, digest) in hashes.items()})
+
+"""_splitTable(table, ind, progress=None)
+		Runs the enumeration and chronology parser over an ItemTable, sorts it
+		and runs the tests on each item. Returns the sorted table, the number
+		of descriptions that couldn't be parsed, and the description cache's
+		hits and misses. Parsing (by far the slowest part) is shown on the
+		given Progress.
+"""
+def _splitTable(table, ind, progress=None):
+	
+	before = _parseDescription.cache_info()
+	(no_match_count, keys) = _parseTable(table, ind, progress)
 		
 	# Sort the items by their bib-level ids ('MMS ID').
-	vol_pattern = re.compile('^(?:[sS][eE][rR]\.?\s*)?(\d+)?\s*(?:[vV][oO]?[lL]?\.?\s*)(\d+)')
-	def sort_key(row):
-		if 'Description' in ind:
-		
-			#   If there is a 'Description', further sort the items by their
-			# pattern-matched volume information, then the whole description.
-			# The volume information is extracted and processed using a regex
-			# pattern so that items are sorted numerically rather than by 
-			# character (such that v10 comes after v2).
-			match = vol_pattern.search(row[ind["Description"]])
-			if match == None:
-				result = (row[ind["MMS ID"]], 0, 0, row[ind["Description"]])
-			else:
-				if match.group(1) == None:
-					preVol = 0
-				else:
-					preVol = int(match.group(1))
-				if match.group(2) == None:
-					volInfo = 0
-				else:
-					volInfo = int(match.group(2))
-					
-				result = (row[ind["MMS ID"]], preVol, volInfo, row[ind["Description"]])
-		else:
-			result = row[ind["MMS ID"]]
-		return result
-	data = data[:1] + sorted(data[1:], key=sort_key)
+	with metrics.stage('sort', len(table)):
+		table.reorder(sorted(range(len(table)), key=keys.__getitem__))
+	_testTable(table, ind)
+	
+	after = _parseDescription.cache_info()
+	return (table, no_match_count, after.hits - before.hits, after.misses - before.misses)
+
+# Runs the enumeration and chronology parser over a table, if the
+# 'Description' field is present in the index list. Returns the number of
+# descriptions that couldn't be parsed and every row's sort key.
+def _parseTable(table, ind, progress=None):
+	no_match_count = 0
+	volumes = None
+	if 'Description' in ind:
+		with metrics.stage('parse', len(table)):
+			(no_match_count, volumes) = _matchRows(table, ind, progress)
+	with metrics.stage('sort'):
+		keys = _sortKeys(table, ind, volumes)
+	return (no_match_count, keys)
+
+# Runs the tests on a sorted table. Only whole titles should be tested
+# together.
+def _testTable(table, ind):
 	
 	#Run various other tests and processes on each item to clean them up.
 	#Currently programmed are Barcode checks, material type check, Chron I
 	#smartguessing, and Chron J reformatting (so far).
 	
 	# Run tests on the barcodes:
-	for row in data[1:]:
-		barcode = row[ind["Barcode"]]
-		# TEST: Lacking barcode
-		if (barcode == "'") or (barcode == None):
-			row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Err: Missing barcode"
-		# TEST: i-barcodes
-		if (len(barcode)>2) and (barcode[1] == 'i'):
-			row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Err: i-barcode"
+	with metrics.stage('barcodes', len(table)):
+		barcodes = table.columns[ind["Barcode"]]
+		notes = table.columns[ind["Notes"]]
+		for i in range(len(table)):
+			barcode = barcodes[i]
+			# TEST: Lacking barcode
+			if (barcode == "'") or (barcode == None):
+				notes[i] += ("; ","")[notes[i] == ''] + "Err: Missing barcode"
+			# TEST: i-barcodes
+			if (len(barcode)>2) and (barcode[1] == 'i'):
+				notes[i] += ("; ","")[notes[i] == ''] + "Err: i-barcode"
 			
 	# Description specific tests:
 	if 'Description' in ind:
+		
+		# TEST: Chron_I "smart guess".
+		with metrics.stage('chron_i', len(table)):
+			_guessChronI(table, ind)
 	
-		# Set up some structures and patterns to be used for the upcoming tests.
-		start_year_pat = re.compile('^(\d+)(.*)')
-		months = [('Jan','(ja\w*)',), ('Feb','(fe\w*)'),('Mar','(ma*r\w*)'),
-		  ('Apr','(ap\w*)'),('May','(ma*y)'),('Jun','(j(?:une|un|n|e))'),
-		  ('Jul','(j(?:uly|ul|l|y))'),('Aug','(au?g\w*)'),('Sep','(se\w*)'),
-		  ('Oct','(oc\w*)'),('"','(no?v\w*)'),('Dec','(de\w*)'),
-		  ('Spr','(spr\w*)'),('Sum','(su\w*)'),('Fal','(fa\w*|au(?!thor|g)\w*)'),
-		  ('Win','(wi\w*)')]
-		month_patterns = [(month[0], re.compile(month[1], re.I)) for month in months]
-	
-		for i in (range(1,len(data))):
-		
-			# TEST: Chron_I "smart guess". Looks for year data encapsulated in
-			# two digit numbers (e.g. Ap-Je98) and reinterprets it as a 4 digit
-			# year depending on its neighbors. Requires the data to be sorted.
-			year_match = start_year_pat.search(data[i][ind["Chron I"]])
-			if year_match != None: # -> Year was provided
-				year = year_match.group(1)
-				remainder = year_match.group(2)
-				if len(year) < 4: # -> Year needs to be reinterpreted
-				
-					# First, record the previous year in the range that has a valid
-					# year format:
-					prev_year = "?"
-					j = 1
-					while (prev_year == "?"):
-						# Only check previous rows as long as they belong to the
-						# same title (i.e. same MMS_ID) and aren't in the header or
-						# an invalid row.
-						if (i-j <= 0) or (data[i-j][ind["MMS ID"]] != data[i][ind["MMS ID"]]):
-							break
-						else:
-							year_match = start_year_pat.search(data[i-j][ind["Chron I"]])
-							# Record the year if it finds a 4 digit year.
-							if (year_match != None) and (len(year_match.group(1)) == 4):
-								prev_year = year_match.group(1)
-							j += 1
-				
-					# Then record the next year in the range that has a valid year format:
-					next_year = "?"
-					j = 1
-					while (next_year == "?"):
-						# Only check next rows as long as they belong to the same
-						# title (i.e. same MMS_ID) and aren't in an an out of range
-						# row.
-						if (i+j >= len(data)) or (data[i+j][ind["MMS ID"]] != data[i][ind["MMS ID"]]):
-							break
-						else:
-							year_match = start_year_pat.search(data[i+j][ind["Chron I"]])
-							# Record the year if it finds a 4 digit year.
-							if (year_match != None) and (len(year_match.group(1)) == 4):
-								next_year = year_match.group(1)
-							j += 1
-
-					if (prev_year != "?") and (next_year != "?"):
-						# Try appending a number of digits from the previous and
-						# next years until(prev year<=current year<=next year) makes
-						# sense.  If it continues to not make sense, check that both
-						# centuries are the same, and use thoes digits. Otherwise
-						# raise an error.
-						digits = 4-len(year) # In case e.g.  '05 -> "5", you'd use the first 3 digits.
-
-						if int(prev_year) <= int(prev_year[:digits] + year) <= int(next_year):
-							data[i][ind["Chron I"]] = prev_year[:digits] + data[i][ind["Chron I"]]
-						elif int(prev_year) <= int(next_year[:digits] + year) <= int(next_year):
-							data[i][ind["Chron I"]] = next_year[:digits] + data[i][ind["Chron I"]]
-						else:
-							# For adjacent centuries, test which interpretation is
-							# closest to the average of the boundary years.
-							test_centuries = [int(prev_year[:2])-1, int(prev_year[:2]), int(prev_year[:2])+1]
-							avg_year = (int(prev_year) + int(next_year))/2
-							avg_diff = [abs(avg_year - (int(cent)*100+int(year))) for cent in test_centuries]
-							data[i][ind["Chron I"]] = str(test_centuries[avg_diff.index(min(avg_diff))]) + data[i][ind["Chron I"]]
-					
-					# If prev_year only remains unknown, guess based on the next
-					# year
-					elif (prev_year == "?") and (next_year != "?"):
-						next_digits = int(next_year[-2:])
-						current_digits = int(year)
-						if current_digits > next_digits: #E.g. ?<'98<2003
-							current_year = int(next_year) - next_digits - 100 + current_digits
-						else: #E.g. ?<'95<1998 or ?<'43<1943
-							current_year = int(next_year) - next_digits + current_digits
-						data[i][ind["Chron I"]] = str(current_year)
-						
-					# If next_year only remains unknown, guess based on the
-					# previous year
-					elif (prev_year != "?") and (next_year == "?"):
-						prev_digits = int(prev_year[-2:])
-						current_digits = int(year)
-						if prev_digits > current_digits: #	E.g. 1998<'03<?
-							current_year = int(prev_year) - prev_digits + 100 + current_digits
-						else: #	E.g. 1992<'95<? or 1943<'43<?
-							current_year = int(prev_year) - prev_digits + current_digits
-						data[i][ind["Chron I"]] = str(current_year)
-					else:
-						data[i][ind["Notes"]] += ("; ","")[data[i][ind["Notes"]] == ''] + "Err: Problem interpreting Chron I"
-							
-			# TEST: Assure proper ChronJ formats (three letter months/seasons,
-			#	capitalized).
-			for pat in month_patterns:
-				data[i][ind["Chron J"]] = pat[1].sub(pat[0], data[i][ind["Chron J"]])
+		# TEST: Assure proper ChronJ formats (three letter months/seasons,
+		#	capitalized).
+		with metrics.stage('chron_j', len(table)):
+			chronJ = table.columns[ind["Chron J"]]
+			chronJ[:] = map(_formatChronJ, chronJ)
+
+"""_splitExternal(rows, header, ind, fills, run_size)
+		Does the same as split() for a stream of rows (without the header),
+		without holding more than run_size of them in memory. The rows are
+		parsed and sorted run_size at a time, and each sorted run is written
+		to a temporary file along with the rows' sort keys. The runs are then
+		merged, and the tests run on each title as it comes out of the merge.
+		Returns the split rows as a stream.
+"""
+def _splitExternal(rows, header, ind, fills, run_size):
+	before = _parseDescription.cache_info()
+	no_match_count = 0
+	runs = []
+	progress = Progress("Sorting runs", every=1000)
+	try:
+		while True:
+			with metrics.stage('read'):
+				table = ItemTable(header, itertools.islice(rows, run_size))
+			metrics.addRows('read', len(table))
+			if len(table) == 0:
+				break
+			with metrics.stage('fill_defaults', len(table)):
+				_fillDefaults(table, fills)
+			(count, keys) = _parseTable(table, ind, progress)
+			no_match_count += count
 			
-	# Write to a new csv file using the provided filename with a prefix
-	# Check for and eliminate already attached prefixes	
-	new_filename = _writeTo('s_', data)
-	return new_filename
+			with metrics.stage('spill', len(table)):
+				run = tempfile.TemporaryFile()
+				runs.append(run)
+				for i in sorted(range(len(table)), key=keys.__getitem__):
+					pickle.dump((keys[i], [column[i] for column in table.columns]), run, pickle.HIGHEST_PROTOCOL)
+				run.seek(0)
+			table = None
+		progress.close()
+		
+		# Each run is already sorted and the runs are in file order, so
+		# merging them keeps rows with the same key in file order too.
+		mms = ind["MMS ID"]
+		group = []
+		merged = heapq.merge(*[_readRun(run) for run in runs], key=lambda item: item[0])
+		for (key, row) in itertools.chain(merged, [(None, None)]):
+			if group and ((row == None) or (row[mms] != group[0][mms])):
+				table = ItemTable(header, group)
+				_testTable(table, ind)
+				for done in table.rowLists():
+					yield done
+				group = []
+			if row != None:
+				group.append(row)
+	finally:
+		for run in runs:
+			run.close()
+	
+	if 'Description' in ind:
+		after = _parseDescription.cache_info()
+		_reportMatches(no_match_count, after.hits - before.hits, after.misses - before.misses)
+
+# Reads back the (key, row) pairs of a sorted run.
+def _readRun(run):
+	while True:
+		try:
+			yield pickle.load(run)
+		except EOFError:
+			return
+
+"""_splitParallel(table, ind, processes, progress=None)
+		Does the same as _splitTable, but shares the work out between a pool
+		of processes. Rows are grouped by title (MMS ID) keeping their order,
+		and the titles are handed out in sorted batches of roughly equal size.
+		Since each batch holds a contiguous run of sorted MMS IDs, putting the
+		sorted batches back together in order gives exactly what sorting the
+		whole file would. The given Progress moves on as each batch is done.
+"""
+def _splitParallel(table, ind, processes, progress=None):
 	
-def update(filename):
+	titles = {}
+	mms_ids = table.columns[ind["MMS ID"]]
+	for i in range(len(table)):
+		titles.setdefault(mms_ids[i], []).append(i)
 	
-	apikey = active_apikey
+	# Aim for a few batches per process so that one huge title doesn't leave
+	# the other processes idle.
+	batch_size = max(1, len(table) // (processes*4))
+	batches = [[]]
+	for mms_id in sorted(titles):
+		if len(batches[-1]) >= batch_size:
+			batches.append([])
+		batches[-1].extend(titles[mms_id])
+	batches = [table.take(batch) for batch in batches]
+	
+	table = ItemTable(table.header)
+	no_match_count = hits = misses = 0
+	with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+		for (result, batch_metrics) in pool.map(_splitBatch, batches, [ind]*len(batches)):
+			table.extendTable(result[0])
+			no_match_count += result[1]
+			hits += result[2]
+			misses += result[3]
+			metrics.merge(batch_metrics)
+			if progress != None:
+				progress.advance(len(result[0]))
+	return (table, no_match_count, hits, misses)
 
-	# This is the shortcut API call that fetches item information using only a
-	# barcode. Super helpful.
-	fetchItemsUrl = 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/items'
+# Splits one batch in a worker process. The metrics it records are sent back
+# along with the result, to be added to the main process's.
+def _splitBatch(table, ind):
+	global metrics
+	metrics = Metrics()
+	return (_splitTable(table, ind), metrics.snapshot())
+
+# Sort the items by their bib-level ids ('MMS ID'). Returns the sort key of
+# every row in the table.
+def _sortKeys(table, ind, volumes=None):
+	mms_ids = table.columns[ind["MMS ID"]]
+	if 'Description' not in ind:
+		return mms_ids
 	
-	# Read the file into useable data
-	data = _readFile(filename)
+	#   If there is a 'Description', further sort the items by their
+	# volume information (as worked out by _parseDescription), then the whole
+	# description.
+	return [(mms_id, volume[0], volume[1], description) for (mms_id, volume, description) in zip(mms_ids, volumes, table.columns[ind["Description"]])]
+
+#   The volume information items are sorted by. It is extracted and processed
+# using a regex pattern so that items are sorted numerically rather than by
+# character (such that v10 comes after v2). Returns (pre-volume, volume)
+# numbers, 0 for any not found.
+vol_pattern = re.compile('^(?:[sS][eE][rR]\.?\s*)?(\d+)?\s*(?:[vV][oO]?[lL]?\.?\s*)(\d+)')
+def _volumeKey(description):
+	match = vol_pattern.search(description)
+	if match == None:
+		return (0, 0)
+	if match.group(1) == None:
+		preVol = 0
+	else:
+		preVol = int(match.group(1))
+	if match.group(2) == None:
+		volInfo = 0
+	else:
+		volInfo = int(match.group(2))
+	return (preVol, volInfo)
+
+# Patterns used to assure proper ChronJ formats (three letter
+# months/seasons, capitalized). Each is matched against a whole word, and
+# the first that matches gives the word's abbreviation.
+months = [('Jan','ja[a-z]*',), ('Feb','fe[a-z]*'),('Mar','ma*r[a-z]*'),
+  ('Apr','ap[a-z]*'),('May','ma*y'),('Jun','j(?:une|un|n|e)'),
+  ('Jul','j(?:uly|ul|l|y)'),('Aug','au?g[a-z]*'),('Sep','se[a-z]*'),
+  ('Oct','oc[a-z]*'),('Nov','no?v[a-z]*'),('Dec','de[a-z]*'),
+  ('Spr','spr[a-z]*'),('Sum','su[a-z]*'),('Fal','fa[a-z]*|au(?!thor|g)[a-z]*'),
+  ('Win','wi[a-z]*')]
+
+# All of the patterns above in one, so a Chron J is scanned only once. Each
+# pattern is its own group, and month_names looks up the abbreviation for
+# whichever group matched.
+month_pattern = re.compile('(?<![a-z])(?:' + '|'.join('(?P<m' + str(i) + '>' + month[1] + ')' for (i, month) in enumerate(months)) + ')(?![a-z])', re.I)
+month_names = {'m' + str(i): month[0] for (i, month) in enumerate(months)}
+
+# There are only so many ways to write a range of months, so each distinct
+# Chron J is formatted once and remembered.
+@functools.lru_cache(maxsize=None)
+def _formatChronJ(chronJ):
+	return month_pattern.sub(lambda match: month_names[match.lastgroup], chronJ)
+
+"""_guessChronI(table, ind)
+		The Chron I "smart guess". Looks for year data encapsulated in two digit
+		numbers (e.g. Ap-Je98) and reinterprets it as a 4 digit year depending
+		on its neighbors: the closest rows before and after it for the same
+		title (i.e. same MMS ID) that have a 4 digit year. Requires the table
+		to be sorted.
+		
+		Rather than searching outwards from every 2 digit year, the neighbors
+		are found with two sweeps over the rows: one backwards, recording the
+		next valid year after each row, and one forwards doing the guessing
+		while keeping track of the previous valid year. The forward sweep reads
+		years after they have been guessed, so a reinterpreted year counts as a
+		valid year for the rows after it.
+"""
+def _guessChronI(table, ind):
 	
-	# Set up data containers (and headers) that will contain the items that
-	# update successfully, and those that have errors or notes warning against
-	# updating.
-	success_data = []
-	success_data.append(data[0])
-	error_data = []
-	error_data.append(data[0])
+	start_year_pat = re.compile('^(\d+)(.*)')
+	mms_ids = table.columns[ind["MMS ID"]]
+	chronI = ind["Chron I"]
+	chron_is = table.columns[chronI]
+	
+	# Returns the 4 digit year a Chron I value starts with, or "?". (The
+	# same as matching start_year_pat and checking for 4 digits, but this
+	# runs on every row.)
+	def validYear(value):
+		if (len(value) >= 4) and value[:4].isdecimal() and not value[4:5].isdecimal():
+			return value[:4]
+		return "?"
+	
+	# Record the next year in the range that has a valid year format, for
+	# every row. Only rows belonging to the same title count.
+	next_years = [None]*len(table)
+	upcoming = "?"
+	for i in range(len(table)-1, -1, -1):
+		if (i+1 < len(table)) and (mms_ids[i+1] != mms_ids[i]):
+			upcoming = "?"
+		next_years[i] = upcoming
+		year = validYear(chron_is[i])
+		if year != "?":
+			upcoming = year
+	
+	prev_year = "?"
+	for i in range(len(table)):
+		if (i > 0) and (mms_ids[i-1] != mms_ids[i]):
+			prev_year = "?"
+		
+		year = validYear(chron_is[i])
+		if year != "?":
+			prev_year = year
+			continue
+		
+		# Only the rows needing a guess are looked at as a whole.
+		row = table[i]
+		year_match = start_year_pat.search(row[chronI])
+		if year_match != None: # -> Year was provided
+			year = year_match.group(1)
+			remainder = year_match.group(2)
+			if len(year) < 4: # -> Year needs to be reinterpreted
+				next_year = next_years[i]
+				
+				if (prev_year != "?") and (next_year != "?"):
+					# Try appending a number of digits from the previous and
+					# next years until(prev year<=current year<=next year) makes
+					# sense.  If it continues to not make sense, check that both
+					# centuries are the same, and use thoes digits. Otherwise
+					# raise an error.
+					digits = 4-len(year) # In case e.g.  '05 -> "5", you'd use the first 3 digits.
 
+					if int(prev_year) <= int(prev_year[:digits] + year) <= int(next_year):
+						row[chronI] = prev_year[:digits] + row[chronI]
+					elif int(prev_year) <= int(next_year[:digits] + year) <= int(next_year):
+						row[chronI] = next_year[:digits] + row[chronI]
+					else:
+						# For adjacent centuries, test which interpretation is
+						# closest to the average of the boundary years.
+						test_centuries = [int(prev_year[:2])-1, int(prev_year[:2]), int(prev_year[:2])+1]
+						avg_year = (int(prev_year) + int(next_year))/2
+						avg_diff = [abs(avg_year - (int(cent)*100+int(year))) for cent in test_centuries]
+						row[chronI] = str(test_centuries[avg_diff.index(min(avg_diff))]) + row[chronI]
+				
+				# If prev_year only remains unknown, guess based on the next
+				# year
+				elif (prev_year == "?") and (next_year != "?"):
+					next_digits = int(next_year[-2:])
+					current_digits = int(year)
+					if current_digits > next_digits: #E.g. ?<'98<2003
+						current_year = int(next_year) - next_digits - 100 + current_digits
+					else: #E.g. ?<'95<1998 or ?<'43<1943
+						current_year = int(next_year) - next_digits + current_digits
+					row[chronI] = str(current_year)
+					
+				# If next_year only remains unknown, guess based on the
+				# previous year
+				elif (prev_year != "?") and (next_year == "?"):
+					prev_digits = int(prev_year[-2:])
+					current_digits = int(year)
+					if prev_digits > current_digits: #	E.g. 1998<'03<?
+						current_year = int(prev_year) - prev_digits + 100 + current_digits
+					else: #	E.g. 1992<'95<? or 1943<'43<?
+						current_year = int(prev_year) - prev_digits + current_digits
+					row[chronI] = str(current_year)
+				else:
+					row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Err: Problem interpreting Chron I"
+				
+				year = validYear(row[chronI])
+				if year != "?":
+					prev_year = year
+
+def update(filename, resume=False, shared=None):
+	
+	# Read the file into useable data. Rows are only made into lists again
+	# as they are sent off.
+	with metrics.stage('read'):
+		table = _readFile(filename)
+	metrics.addRows('read', len(table))
+	_updateStream(itertools.chain([table.header], table.rowLists()), filename, resume, len(table), shared)
+
+"""_updateStream(rows, source, resume=False, numItems=None, shared=None)
+		Pushes a stream of rows (header first) into Alma, writing the items
+		that update successfully to 'suc_' and the rest to 'err_', named after
+		the 'source' file. Rows are taken from the stream as workers become
+		free. numItems is the number of items in the stream, if it is known.
+		The items are sent by the given UpdateWorkers, or by ones set up just
+		for this update.
+"""
+def _updateStream(rows, source, resume=False, numItems=None, shared=None):
+	header = next(rows)
+	
 	#print("Updating " + filename)
 	
 	# Verify columns and fetch their locations. These will force close the program if they
 	# are not present.
 
-	(data, ind, nums, der) = _checkColumns(data, mand, opt, add)
-	# Always add the "Notes" column if it isn't present.
-	if "Notes" not in data[0]:
-		for row in data:
-			row.append("")
-		data[0][-1] = "Notes"
-	ind["Notes"] = data[0].index("Notes")
+	with metrics.stage('check_columns'):
+		(data, ind, nums, der) = _checkColumns([header], mand, opt, add)
+		# Always add the "Notes" column if it isn't present.
+		if "Notes" not in header:
+			header.append("Notes")
+		ind["Notes"] = header.index("Notes")
+		
+		# Note the location of a "Pattern" column if it is present.
+		if "Pattern" in header:
+			ind["Pattern"] = header.index("Pattern")
+	
+	# Every row is checked before any of them is sent, so rows that can't
+	# succeed go straight to 'err_' without spending requests on them. Rows
+	# with the same barcode are then planned so that the item is only sent
+	# once. Rows streamed in are checked a chunk at a time. Rows get blanks
+	# for any columns added to the header along the way. Each row comes out
+	# with whether it's a duplicate.
+	invalid = 0
+	conflicts = 0
+	planned = {}
+	def validated():
+		nonlocal invalid, conflicts
+		while True:
+			table = ItemTable(header, itertools.islice(rows, numItems or validation_chunk_size))
+			if len(table) == 0:
+				return
+			with metrics.stage('validate', len(table)):
+				invalid += _validateTable(table, ind)
+			with metrics.stage('plan', len(table)):
+				(duplicates, count) = _coalesceTable(table, ind, planned)
+				conflicts += count
+			for item in zip(table.rowLists(), duplicates):
+				yield item
+	
+	# A single client (and its connection pool) is shared by every worker.
+	own_workers = (shared == None)
+	if own_workers:
+		shared = UpdateWorkers(update_workers)
+	client = shared.client
 	
-	# Note the location of a "Pattern" column if it is present.
-	if "Pattern" in data[0]:
-		ind["Pattern"] = data[0].index("Pattern")
+	# Every finished item is recorded in the journal straight away, so an
+	# interrupted run can be picked back up with --resume. Items the journal
+	# already marks as updated are not sent to Alma again.
+	journal = ProgressJournal(_outputName('jrn_', source), resume)
+	def work(item):
+		(row, duplicate) = item
+		if duplicate:
+			return ('duplicate', row, None)
+		barcode = row[ind["Barcode"]]
+		if journal.isDone(barcode):
+			return ('success', row, "  -Skipped, item was already updated")
+		result = _updateItem(client, row, ind)
+		journal.record(barcode, result[0])
+		return result
 	
-	numItems = len(data[1:])
+	progress = Progress("Updating", numItems)
+	unchanged = 0
+	duplicated = 0
 	ts0 = time.time()
-	for i in range(numItems):
-		row = data[i+1]
-		print("Processing item " + str(i+1) + " of " + str(numItems))
-		# First, weed out the items previously identified to have problems.
-		if row[ind["Notes"]].find("Err") > -1:
-			error_data.append(row)
-			print("  -Skipped, item has error")
-		elif ("Pattern" in ind) and (row[ind["Pattern"]]=="N/A"):
-			error_data.append(row)
-			print("  -Skipped, item's description could not be matched")
-		else:
-			barcode = row[ind["Barcode"]][1:] # To account for apostrophes
-			
-			# Fetch the item data from Alma
-			alma_request = requests.get(fetchItemsUrl, params = {'apikey':apikey, 'item_barcode':barcode})
-			
-			# Catch cases where data was not successfully fetched
-			if (alma_request.status_code != 200):
-				error_data.append(row)
-				error_data[-1][ind["Notes"]] = "Err: Problem fetching item information. Code " + str(alma_request.status_code)
-			else:
-				root = ET.fromstring(alma_request.text)
-				
-				#Fetch the URL that will push data back into Alma
-				updateUrl = root.get('link')
-				item_data = root.find('item_data')
-				
-				"""
-					#TODO: Update this to reflect the additional and optional columns
-					#TODO: Add a column name to column_key conversion table
-				"""
-				# Edit the Material Type field if it exists, create it
-				# otherwise. Note Material Type has a code table included at the
-				# beginning of this document.  The keys within are the publicly
-				# visible descriptions, and the keys' values are what is needed
-				# to update the code properly.
-				if (ind["Material Type"] > -1):
-					mattype_element = item_data.find('physical_material_type')
-					if mattype_element == None:
-						# -> Field doesn't exists in data: add child to XML
-						mattype_element = ET.SubElement(item_data,'physical_material_type')
-					mattype_element.text = code_tables["Material Type"][row[ind["Material Type"]]]
-					mattype_element.set('desc',row[ind["Material Type"]])
-					
-				# Edit the Item Policy field if it exists, create it otherwise.
-				# Note Item Policy has a code table included at the beginning
-				# of this document.  The keys within are the publicly visible
-				# descriptions, and the keys' values are what is needed to
-				# update the code properly.
-				if (ind["Item Policy"] > -1):
-					itemtype_element = item_data.find('policy')
-					if itemtype_element == None:
-						# -> Field doesn't exists in data: add child to XML
-						itemtype_element = ET.SubElement(item_data,'policy')
-					itemtype_element.text = code_tables["Item Policy"][row[ind["Item Policy"]]]
-					itemtype_element.set('desc',row[ind["Item Policy"]])
-				
-				# Edit the Enum A field if it exists, create it otherwise. ONLY if Enum A needs to be added.
-				if (row[ind["Enum A"]] != None) and (row[ind["Enum A"]] != ''):
-					enumA_element = item_data.find('enumeration_a')
-					if enumA_element == None:
-						# -> Field doesn't exists in data: add child to XML
-						enumA_element = ET.SubElement(item_data,'enumeration_a')
-					enumA_element.text = row[ind["Enum A"]]
-					
-				# Edit the Enum B field if it exists, create it otherwise. ONLY if Enum B needs to be added.
-				if (row[ind["Enum B"]] != None) and (row[ind["Enum B"]] != ''):
-					enumB_element = item_data.find('enumeration_b')
-					if enumB_element == None:
-						# -> Field doesn't exists in data: add child to XML
-						enumB_element = ET.SubElement(item_data,'enumeration_b')
-					enumB_element.text = row[ind["Enum B"]]
-				
-				# Edit the Chron I field if it exists, create it otherwise. ONLY if Chron I needs to be added.
-				if (row[ind["Chron I"]] != None) and (row[ind["Chron I"]] != ''):
-					chronI_element = item_data.find('chronology_i')
-					if chronI_element == None:
-						# -> Field doesn't exists in data: add child to XML
-						chronI_element = ET.SubElement(item_data,'chronology_i')
-					chronI_element.text = row[ind["Chron I"]]
-				
-				# Edit the Chron J field if it exists, create it otherwise. ONLY if Chron J needs to be added.
-				if (row[ind["Chron J"]] != None) and (row[ind["Chron J"]] != ''):
-					chronJ_element = item_data.find('chronology_j')
-					if chronJ_element == None:
-						# -> Field doesn't exists in data: add child to XML
-						chronJ_element = ET.SubElement(item_data,'chronology_j')
-					chronJ_element.text = row[ind["Chron J"]]
-				
-				# Format the output xml in a way Alma enjoys.
-				output_xml = str(ET.tostring(root, encoding='utf-8'))[2:-1]
+	
+	# Set up the output files (and headers) that will contain the items that
+	# update successfully, and those that have errors or notes warning against
+	# updating. Items are written out as soon as their results are in.
+	success_output = CsvOutput('suc_', source)
+	success_output.write(header)
+	error_output = CsvOutput('err_', source)
+	error_output.write(header)
+	
+	# Items are sent to Alma concurrently, but the results are handed back in
+	# the same order as the input file so the output files keep that order.
+	# That also means the result for a barcode is always in by the time its
+	# duplicates come up, as the first row for a barcode is the one sent.
+	processed = 0
+	outcomes = {}
+	with metrics.stage('update'):
+		results = _orderedMap(shared.pool, work, validated(), shared.workers*4)
+		try:
+			for (status, row, message) in results:
+				# Only errors are worth stopping to show, the reasons items
+				# were skipped are in their Notes.
+				if (message != None) and (status == 'error'):
+					progress.message(message)
+				progress.advance(status=status)
+				metrics.addItem(status)
+				processed += 1
 				
-				# Make the second request pushing data into Alma.
-				request2 = requests.put(updateUrl, params = {'apikey':apikey}, headers = {'Content-Type':'application/xml'}, data = output_xml)
-				if (request2.status_code == 200):
-					success_data.append(row)
+				# Duplicates end up wherever the row sent for them did.
+				barcode = row[ind["Barcode"]]
+				if status == 'duplicate':
+					duplicated += 1
+					updated = outcomes.get(barcode) in ('success', 'unchanged')
+					if updated:
+						row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Duplicate, sent with an earlier row"
+					else:
+						row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Err: Duplicate of an earlier row that failed"
 				else:
-					error_data.append(row)
-					error_data[-1][ind["Notes"]] += ("; ","")[error_data[-1][ind["Notes"]] == ''] + "Err: #Problem with Networking request. Code " + str(request2.status_code)
-					print("Item " + row[ind["Barcode"]] + ": Error. Code " + str(request2.status_code))
+					outcomes[barcode] = status
+					updated = status in ('success', 'unchanged')
 				
+				if status == 'unchanged':
+					unchanged += 1
+				if updated:
+					success_output.write(row)
+				else:
+					error_output.write(row)
+		except KeyboardInterrupt:
+			print("Update interrupted. Run again with --resume to pick up where it left off.")
+			raise
+		finally:
+			# Items already being sent are allowed to finish (and be journaled),
+			# anything still waiting is dropped.
+			progress.close()
+			results.close()
+			journal.close()
+			if own_workers:
+				shared.close()
+			success_output.close()
+			error_output.close()
+			metrics.addRows('update', processed)
 	
-	_writeTo('suc_',success_data)
-	_writeTo('err_',error_data)
+	if invalid > 0:
+		print(str(invalid) + " item" + ("","s")[invalid > 1] + " failed the checks before updating, so " + ("was","were")[invalid > 1] + " not sent to Alma")
+	if conflicts > 0:
+		print(str(conflicts) + " item" + ("","s")[conflicts > 1] + " shared a barcode with rows holding different values, so " + ("was","were")[conflicts > 1] + " not sent to Alma")
+	if duplicated > 0:
+		print(str(duplicated) + " item" + ("","s")[duplicated > 1] + " repeated an earlier row's barcode and values, so " + ("was","were")[duplicated > 1] + " only sent once")
+	if unchanged > 0:
+		print(str(unchanged) + " item" + ("","s")[unchanged > 1] + " already matched Alma, so no update was sent")
 	ts1 = time.time()
 	print("Time to complete: " + str(round(ts1-ts0,2)) + " seconds")
+
+"""pipeline(filename, formatting, splitting, keep=False, resume=False, shared=None)
+		Runs format() and/or split() and then update() on a file all at once.
+		Each stage runs in its own thread and hands rows to the next through a
+		bounded queue, so nothing is held in memory or written to disk in
+		between (unless keep is set, when the usual 'f_' and 's_' files are
+		also written as rows pass through). Items are sent to Alma by the
+		given UpdateWorkers, if any.
+"""
+def pipeline(filename, formatting, splitting, keep=False, resume=False, shared=None):
+	print("Running "+filename+" through the pipeline...")
+	
+	if formatting:
+		rows = _formatStream(MappedCsv(filename))
+		if keep:
+			rows = _teeTo('f_', filename, rows)
+		rows = _pipe(rows, pipeline_queue_size)
+	else:
+		rows = _iterFile(filename)
+	if splitting:
+		rows = _splitStream(rows)
+		if keep:
+			rows = _teeTo('s_', filename, rows)
+		rows = _pipe(rows, pipeline_queue_size)
+	_updateStream(rows, filename, resume, shared=shared)
+
+"""_pipe(rows, size)
+		Runs a stream of rows in a thread of its own, handing the rows over
+		through a queue that holds at most 'size' of them. Anything raised
+		while producing rows is raised again for the consumer.
+"""
+def _pipe(rows, size):
+	handover = queue.Queue(maxsize=size)
+	finished = object()
+	failure = []
+	
+	def produce():
+		try:
+			for row in rows:
+				handover.put(row)
+		except BaseException as e:
+			failure.append(e)
+		finally:
+			handover.put(finished)
+	threading.Thread(target=produce, daemon=True).start()
+	
+	def consume():
+		while True:
+			row = handover.get()
+			if row is finished:
+				break
+			yield row
+		if failure:
+			raise failure[0]
+	return consume()
+
+"""prefetch()
+		-takes a csv file and fetches every item that update() would send to
+		Alma into the local item cache ahead of time. Items that are already
+		cached aren't fetched again. Items are fetched by the given
+		UpdateWorkers, or by ones set up just for this.
+"""
+def prefetch(filename, shared=None):
+	
+	if not item_cache_file:
+		print("The item cache is turned off, so there is nothing to prefetch into (use --cache=FILE)")
+		return
+	
+	print("Prefetching items from "+filename+"...")
+	
+	# Read the file into useable data. Columns _checkColumns adds to the
+	# header are added to the table as blanks, as update() does.
+	table = _readFile(filename)
+	header = list(table.header)
+	(data, ind, nums, der) = _checkColumns([header], mand, opt, add)
+	for col in header[len(table.header):]:
+		table.addColumn(col)
+	if "Notes" not in table.header:
+		table.addColumn("Notes")
+	ind["Notes"] = table.header.index("Notes")
+	if "Pattern" in table.header:
+		ind["Pattern"] = table.header.index("Pattern")
+	
+	# Rows that update() would turn away before sending aren't fetched either.
+	with metrics.stage('validate', len(table)):
+		_validateTable(table, ind)
+	with metrics.stage('plan', len(table)):
+		duplicates = _coalesceTable(table, ind, {})[0]
+	
+	own_workers = (shared == None)
+	if own_workers:
+		shared = UpdateWorkers(update_workers)
+	client = shared.client
+	(hits, misses) = (client.cache.hits, client.cache.misses)
+	
+	# Only fetch the rows update() won't skip, once per barcode.
+	def work(item):
+		(row, duplicate) = item
+		if duplicate or (_skipReason(row, ind) != None):
+			return None
+		try:
+			return client.fetchItem(row[ind["Barcode"]][1:])[0]
+		except (BudgetExhaustedError, requests.exceptions.RequestException):
+			return -1
+	
+	failed = 0
+	progress = Progress("Prefetching", len(table))
+	results = _orderedMap(shared.pool, work, zip(table.rowLists(), duplicates), shared.workers*4)
+	try:
+		with metrics.stage('prefetch', len(table)):
+			for status_code in results:
+				if status_code == None:
+					progress.advance(status='skipped')
+				elif status_code == 200:
+					progress.advance(status='ready')
+				else:
+					failed += 1
+					progress.advance(status='failed')
+	finally:
+		progress.close()
+		results.close()
+		cached = client.cache.hits - hits
+		fetched = client.cache.misses - misses - failed
+		if own_workers:
+			shared.close()
+	
+	print(str(fetched) + " items fetched, " + str(cached) + " already cached, " + str(failed) + " could not be fetched\n")
+
+"""_validateTable(table, ind)
+		The pre-flight check run over an ItemTable before any of it is sent to
+		Alma. Each row must have a barcode, formatted with its leading "'"
+		(by -f), that isn't an i-barcode, and every column that is looked up
+		in code_tables must hold a value the code table knows, or be blank
+		(a blank isn't sent, so Alma's field is left as it is). Rows failing
+		a check have the reason added to their 'Notes' as an error, so they
+		are skipped by update() and end up in 'err_'. Rows already marked with
+		an error aren't checked. Works down a column at a time, and only looks
+		at the rows of a code table column if a value in it is unknown.
+		Returns the number of rows that failed.
+"""
+def _validateTable(table, ind):
+	notes = table.columns[ind["Notes"]]
+	problems = [None] * len(table)
+	
+	barcodes = table.columns[ind["Barcode"]]
+	for i in range(len(table)):
+		barcode = barcodes[i]
+		if (barcode == "") or (barcode == "'"):
+			problems[i] = "Err: Missing barcode"
+		elif barcode[0] != "'":
+			problems[i] = "Err: Barcode not formatted (run -f first)"
+		elif barcode[1] == 'i':
+			problems[i] = "Err: i-barcode"
+	
+	for colname in code_tables:
+		if colname not in ind:
+			continue
+		column = table.columns[ind[colname]]
+		unknown = set(column).difference(code_tables[colname])
+		unknown.discard("")
+		if unknown:
+			for i in range(len(table)):
+				if (column[i] in unknown) and (problems[i] == None):
+					problems[i] = "Err: " + colname + " '" + column[i] + "' is not in the code table"
+	
+	invalid = 0
+	for i in range(len(table)):
+		if (problems[i] != None) and (notes[i].find("Err") == -1):
+			notes[i] += ("; ","")[notes[i] == ''] + problems[i]
+			invalid += 1
+	return invalid
+
+"""_coalesceTable(table, ind, planned)
+		The planning pass run over an ItemTable after _validateTable, so that
+		each item (barcode) is fetched once and pushed at most once. Of the
+		rows that would be sent for a barcode, only the first is; later rows
+		with the same values in every column of item_fields are marked as
+		duplicates, to share its result. If the rows disagree on any of those
+		values there's no telling which is right, so they all get an error in
+		their Notes instead (any already sent can't be taken back).
+		'planned' holds the values planned for each barcode so far (None once
+		they've disagreed), and carries on from one chunk of a stream to the
+		next. Returns whether each row is a duplicate, and the number of rows
+		given errors.
+"""
+def _coalesceTable(table, ind, planned):
+	barcodes = table.columns[ind["Barcode"]]
+	notes = table.columns[ind["Notes"]]
+	columns = [table.columns[ind[column]] for (column, tag) in item_fields if column in ind]
+	if columns:
+		values = list(zip(*columns))
+	else:
+		values = [()] * len(table)
+	
+	rows = {}
+	for i in range(len(table)):
+		if _skipReason(table[i], ind) == None:
+			rows.setdefault(barcodes[i], []).append(i)
+	
+	duplicates = [False] * len(table)
+	conflicts = []
+	for (barcode, indexes) in rows.items():
+		if barcode in planned:
+			(first, later) = (planned[barcode], indexes)
+		else:
+			(first, later) = (values[indexes[0]], indexes[1:])
+		if (first != None) and all(values[i] == first for i in later):
+			planned[barcode] = first
+			for i in later:
+				duplicates[i] = True
+		else:
+			conflicts.extend(later if barcode in planned else indexes)
+			planned[barcode] = None
+	
+	for i in conflicts:
+		notes[i] += ("; ","")[notes[i] == ''] + "Err: Barcode is in the file more than once, with different values"
+	return (duplicates, len(conflicts))
+
+"""_updateItem(client, row, ind)
+		Pushes a single row's information into Alma. Returns a (status, row,
+		message) tuple, where message is anything that should be shown to the
+		user about the item (or None). The status is one of:
+			'success': the item was updated.
+			'unchanged': Alma already held the row's values; nothing was sent.
+			'skipped': the row was marked as having a problem beforehand.
+			'error': fetching or updating the item failed.
+		Rows that fail have the reason recorded in their 'Notes' column, rows
+		that succeed have the fields that were changed.
+"""
+def _updateItem(client, row, ind):
+	
+	# First, weed out the items previously identified to have problems.
+	reason = _skipReason(row, ind)
+	if reason != None:
+		return ('skipped', row, "  -Skipped, " + reason)
+	
+	# Requests that still fail after the scheduler's retries (or that could
+	# not be made at all) are recorded against the item rather than stopping
+	# the whole run.
+	try:
+		return _pushItem(client, row, ind)
+	except BudgetExhaustedError:
+		row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Err: Daily API call budget used up"
+		return ('error', row, None)
+	except requests.exceptions.RequestException as e:
+		row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Err: Problem with Networking request. " + type(e).__name__
+		return ('error', row, "Item " + row[ind["Barcode"]] + ": Error. " + type(e).__name__)
+
+# Returns why a row shouldn't be sent to Alma, or None if it should be.
+def _skipReason(row, ind):
+	if ("Notes" in ind) and (row[ind["Notes"]].find("Err") > -1):
+		return "item has error"
+	elif ("Pattern" in ind) and (row[ind["Pattern"]]=="N/A"):
+		return "item's description could not be matched"
+	return None
+
+# Fetches an item from Alma, edits it to match its row and pushes it back.
+def _pushItem(client, row, ind):
+	
+	barcode = row[ind["Barcode"]][1:] # To account for apostrophes
+	
+	# Fetch the item data from Alma (or the item cache)
+	(status_code, item_xml) = client.fetchItem(barcode)
+	
+	# Catch cases where data was not successfully fetched
+	if (status_code != 200):
+		row[ind["Notes"]] = "Err: Problem fetching item information. Code " + str(status_code)
+		return ('error', row, None)
+	
+	root = ET.fromstring(item_xml)
+	
+	#Fetch the URL that will push data back into Alma
+	updateUrl = root.get('link')
+	item_data = root.find('item_data')
+	
+	# Each field is only changed (and noted in 'changed') if Alma doesn't
+	# already hold the row's value.
+	changed = _patchItem(item_data, row, ind)
+	
+	# Nothing to change: don't spend a request pushing the same data back.
+	if len(changed) == 0:
+		row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Unchanged"
+		return ('unchanged', row, None)
+	
+	# Send the xml as UTF-8 bytes (XML's default encoding), so any character
+	# in the item survives the trip as it is.
+	output_xml = ET.tostring(root, encoding='utf-8')
+	
+	# Make the second request pushing data into Alma.
+	request2 = client.putItem(updateUrl, output_xml, barcode)
+	if (request2.status_code == 200):
+		row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Changed: " + " ".join(changed)
+		return ('success', row, None)
+	else:
+		row[ind["Notes"]] += ("; ","")[row[ind["Notes"]] == ''] + "Err: #Problem with Networking request. Code " + str(request2.status_code)
+		return ('error', row, "Item " + row[ind["Barcode"]] + ": Error. Code " + str(request2.status_code))
+
+"""_patchItem(item_data, row, ind)
+		Writes a row's values into an item's fields as laid out in item_fields,
+		adding any field the item doesn't have yet. The item's fields are
+		looked through once. Returns the fields whose values actually changed.
+"""
+def _patchItem(item_data, row, ind):
+	
+	# The (text, desc) each field should end up with.
+	values = {}
+	for (column, tag) in item_fields:
+		if (column in ind) and row[ind[column]]:
+			value = row[ind[column]]
+			if column in code_tables:
+				values[tag] = (code_tables[column][value], value)
+			else:
+				values[tag] = (value, None)
+	
+	elements = {}
+	for element in item_data:
+		if (element.tag in values) and (element.tag not in elements):
+			elements[element.tag] = element
+	
+	changed = []
+	for (tag, (text, desc)) in values.items():
+		element = elements.get(tag)
+		if element == None:
+			# -> Field doesn't exists in data: add child to XML
+			element = ET.SubElement(item_data, tag)
+		elif element.text == text:
+			continue
+		element.text = text
+		if desc != None:
+			element.set('desc', desc)
+		changed.append(tag)
+	return changed
+
+"""UpdateWorkers(workers)
+		The AlmaClient (see _newClient) and pool of threads that update() and
+		prefetch() send items to Alma with, for 'workers' workers at once.
+		Stages that are handed one use it rather than setting up their own,
+		so watch() can keep the same connections and threads from one file to
+		the next.
+"""
+class UpdateWorkers:
+
+	def __init__(self, workers):
+		self.workers = workers
+		self.client = _newClient(workers)
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+	
+	def close(self):
+		self.pool.shutdown(cancel_futures=True)
+		self.client.close()
+
+"""_newClient(workers)
+		Sets up an AlmaClient, along with the scheduler and item cache it
+		uses, for the given number of workers.
+"""
+def _newClient(workers):
+	
+	apikey = active_apikey
+
+	# This is the shortcut API call that fetches item information using only a
+	# barcode. Super helpful.
+	fetchItemsUrl = alma_api_url.rstrip('/') + '/items'
+	
+	# The scheduler keeps the run as a whole inside Alma's limits.
+	scheduler = RequestScheduler(requests_per_second, daily_call_budget, max_retries, retry_backoff, retry_statuses, call_count_file)
+	if item_cache_file:
+		cache = ItemCache(item_cache_file, item_cache_ttl, item_cache_size)
+	else:
+		cache = None
+	return AlmaClient(apikey, fetchItemsUrl, scheduler, cache, workers, (connect_timeout, read_timeout), hedge_percentile)
+
+"""AlmaClient
+		Makes the network calls against the Alma API. A single client is
+		shared between all of update()'s workers, so its requests.Session
+		keeps connections alive and reuses them instead of opening a fresh
+		connection for every GET and PUT. Items are looked up in the item
+		cache (if there is one) before being fetched. Cached items are kept
+		apart by the API they came from, so an item fetched from a test
+		server is never pushed to the real one.
+		
+		Every request is made with the given (connect, read) timeout. If
+		'hedge' is a percentile, slow GETs are hedged: see _hedgedGet.
+"""
+class AlmaClient:
+
+	def __init__(self, apikey, fetchItemsUrl, scheduler, cache=None, workers=1, timeout=None, hedge=None):
+		self.apikey = apikey
+		self.fetchItemsUrl = fetchItemsUrl
+		self.scheduler = scheduler
+		self.cache = cache
+		self.timeout = timeout
+		self.hedge = hedge
+		
+		# Each worker can be waiting on two hedged GETs at once.
+		if hedge:
+			self.hedge_delay = None
+			self.hedge_checked = 0
+			connections = workers*2
+		else:
+			connections = workers
+		
+		# Size the connection pool to the number of workers so no worker has
+		# to wait on (or throw away) a connection.
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+	
+	# Fetch an item's record using only its barcode. Returns a (status code,
+	# item xml) tuple.
+	def fetchItem(self, barcode):
+		if self.cache != None:
+			item_xml = self.cache.get(self._cacheKey(barcode))
+			if item_xml != None:
+				return (200, item_xml)
+		
+		if self.hedge:
+			get = self._hedgedGet
+		else:
+			get = self._timed
+		response = self.scheduler.call(get, 'GET', self.session.get, self.fetchItemsUrl, params = {'apikey':self.apikey, 'item_barcode':barcode}, timeout = self.timeout)
+		if (response.status_code == 200) and (self.cache != None):
+			self.cache.put(self._cacheKey(barcode), response.text)
+		return (response.status_code, response.text)
+	
+	# Push an item's updated record back into Alma. The cached copy is out of
+	# date once this succeeds.
+	def putItem(self, url, xml, barcode):
+		response = self.scheduler.call(self._timed, 'PUT', self.session.put, url, params = {'apikey':self.apikey}, headers = {'Content-Type':'application/xml'}, data = xml, timeout = self.timeout)
+		if (response.status_code == 200) and (self.cache != None):
+			self.cache.invalidate(self._cacheKey(barcode))
+		return response
+	
+	def _cacheKey(self, barcode):
+		return self.fetchItemsUrl + '?item_barcode=' + barcode
+	
+	# Makes a single request, recording how long it took and how it went
+	# in the metrics. Retries are recorded as requests of their own.
+	def _timed(self, method, func, *args, **kwargs):
+		start = time.perf_counter()
+		try:
+			response = func(*args, **kwargs)
+		except requests.exceptions.RequestException as e:
+			metrics.addRequest(method, time.perf_counter() - start, type(e).__name__)
+			raise
+		metrics.addRequest(method, time.perf_counter() - start, response.status_code)
+		return response
+	
+	# Makes a GET, and if it hasn't been answered within the hedge
+	# percentile of GET times, makes the same GET again. Whichever comes back
+	# first is used (unless it failed and the other didn't); the other is
+	# left to finish in the background.
+	def _hedgedGet(self, method, func, *args, **kwargs):
+		first = self._startGet(method, func, *args, **kwargs)
+		delay = self._hedgeDelay()
+		if delay == None:
+			return first.result()
+		try:
+			return first.result(timeout=delay)
+		except concurrent.futures.TimeoutError:
+			pass
+		
+		# The second GET takes a turn like any other request, but is only
+		# worth making if the first still hasn't come back by then.
+		try:
+			self.scheduler.reserve()
+		except BudgetExhaustedError:
+			return first.result()
+		if first.done():
+			return first.result()
+		second = self._startGet(method, func, *args, **kwargs)
+		metrics.addEvent('GET hedged')
+		
+		pending = [first, second]
+		while True:
+			done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				if (future.exception() == None) or not not_done:
+					if future is second:
+						metrics.addEvent('GET hedge answered first')
+					return future.result()
+			pending = list(not_done)
+	
+	# Starts a GET on a thread of its own, returning a future for its
+	# response. The GET starts straight away, so the hedge delay is measured
+	# from the same moment as its recorded time, and GETs left running after
+	# a hedge can't hold up the ones after them (as they could in a pool).
+	def _startGet(self, method, func, *args, **kwargs):
+		future = concurrent.futures.Future()
+		def run():
+			future.set_running_or_notify_cancel()
+			try:
+				future.set_result(self._timed(method, func, *args, **kwargs))
+			except Exception as e:
+				future.set_exception(e)
+		threading.Thread(target=run, daemon=True).start()
+		return future
+	
+	# The hedge percentile of the latest GET times, or None until there have
+	# been enough GETs. Worked out again every hedge_min_samples GETs.
+	def _hedgeDelay(self):
+		self.hedge_checked += 1
+		if (self.hedge_delay == None) or (self.hedge_checked >= hedge_min_samples):
+			self.hedge_checked = 0
+			delay = metrics.recentPercentile('GET', self.hedge, hedge_min_samples)
+			if delay != None:
+				self.hedge_delay = delay
+		return self.hedge_delay
+	
+	def close(self):
+		self.session.close()
+		self.scheduler.close()
+		if self.cache != None:
+			self.cache.close()
+
+"""ItemCache
+		An on-disk SQLite cache of item records fetched from Alma, keyed by
+		barcode. Entries older than 'ttl' seconds count as missing, and when
+		the cache grows past 'size' items the least recently used are evicted.
+		It can be shared between threads.
+"""
+class ItemCache:
+
+	def __init__(self, filename, ttl, size):
+		self.ttl = ttl
+		self.size = size
+		self.lock = threading.Lock()
+		
+		# Autocommit with write-ahead logging keeps each write cheap while still
+		# leaving a consistent cache behind if the run is cut short.
+		self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS items (barcode TEXT PRIMARY KEY, xml TEXT NOT NULL, fetched REAL NOT NULL, used REAL NOT NULL)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS items_used ON items (used)")
+		self.count = self.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+		
+		self.hits = 0
+		self.misses = 0
+	
+	# Returns the cached xml for a barcode, or None if it isn't cached (or
+	# has expired).
+	def get(self, barcode):
+		now = time.time()
+		with self.lock:
+			found = self.conn.execute("SELECT xml, fetched FROM items WHERE barcode = ?", (barcode,)).fetchone()
+			if (found == None) or (now - found[1] > self.ttl):
+				self.misses += 1
+				return None
+			self.conn.execute("UPDATE items SET used = ? WHERE barcode = ?", (now, barcode))
+			self.hits += 1
+			return found[0]
+	
+	def put(self, barcode, xml):
+		now = time.time()
+		with self.lock:
+			self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)", (barcode, xml, now, now))
+			self.count += 1
+			if self.count > self.size:
+				self._evict()
+	
+	def invalidate(self, barcode):
+		with self.lock:
+			self.conn.execute("DELETE FROM items WHERE barcode = ?", (barcode,))
+	
+	# Drop the least recently used items, plus some slack so eviction doesn't
+	# run on every insert once the cache is full.
+	def _evict(self):
+		self.count = self.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+		excess = self.count - self.size
+		if excess > 0:
+			excess += self.size // 10
+			self.conn.execute("DELETE FROM items WHERE barcode IN (SELECT barcode FROM items ORDER BY used LIMIT ?)", (excess,))
+			self.count = self.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+	
+	def close(self):
+		with self.lock:
+			self.conn.close()
+
+"""SplitCache
+		An on-disk SQLite cache of the rows split() made of each title, keyed
+		by a hash of the title's rows before splitting (see _titleKeys). When
+		the cache grows past 'size' titles the least recently used are
+		evicted.
+"""
+class SplitCache:
+
+	def __init__(self, filename, size):
+		self.size = size
+		self.conn = sqlite3.connect(filename, isolation_level=None)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS titles (key TEXT PRIMARY KEY, rows BLOB NOT NULL, used REAL NOT NULL)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS titles_used ON titles (used)")
+	
+	# Returns the split rows of each of the keys that are cached, by key.
+	def getMany(self, keys):
+		now = time.time()
+		keys = list(keys)
+		found = {}
+		self.conn.execute("BEGIN")
+		for start in range(0, len(keys), 500):
+			batch = keys[start:start+500]
+			query = "SELECT key, rows FROM titles WHERE key IN (" + ",".join("?" * len(batch)) + ")"
+			for (key, rows) in self.conn.execute(query, batch):
+				found[key] = pickle.loads(rows)
+		self.conn.executemany("UPDATE titles SET used = ? WHERE key = ?", ((now, key) for key in found))
+		self.conn.execute("COMMIT")
+		return found
+	
+	# Adds (key, split rows) pairs to the cache.
+	def putMany(self, entries):
+		now = time.time()
+		self.conn.execute("BEGIN")
+		self.conn.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?, ?)", ((key, pickle.dumps(rows, pickle.HIGHEST_PROTOCOL), now) for (key, rows) in entries))
+		self.conn.execute("COMMIT")
+		self._evict()
+	
+	# Drop the least recently used titles, plus some slack so eviction doesn't
+	# happen on every run once the cache is full.
+	def _evict(self):
+		excess = self.conn.execute("SELECT COUNT(*) FROM titles").fetchone()[0] - self.size
+		if excess > 0:
+			excess += self.size // 10
+			self.conn.execute("DELETE FROM titles WHERE key IN (SELECT key FROM titles ORDER BY used LIMIT ?)", (excess,))
+	
+	def close(self):
+		self.conn.close()
+
+"""RequestScheduler
+		Sits between AlmaClient and the network. Every request waits for its
+		turn so that the run as a whole stays under 'rate' requests per
+		second, and no more than 'budget' requests are made in a day. The
+		day's count is kept in the SQLite file 'countfile' (when given), so it
+		is shared by every run that day, including ones running at once.
+		Responses with a status code in 'statuses' (and connection problems)
+		are retried up to 'retries' times with jittered exponential backoff,
+		which only holds up the worker making the request. A 429, or any
+		response with a Retry-After, holds off every worker until it passes.
+"""
+class RequestScheduler:
+
+	def __init__(self, rate, budget, retries, backoff, statuses, countfile=None):
+		if rate:
+			self.interval = 1.0/rate
+		else:
+			self.interval = 0
+		self.budget = budget
+		self.retries = retries
+		self.backoff = backoff
+		self.statuses = set(statuses)
+		
+		self.lock = threading.Lock()
+		self.next_slot = time.monotonic()
+		self.day = datetime.date.today()
+		self.calls = 0
+		
+		self.conn = None
+		if countfile:
+			self.conn = sqlite3.connect(countfile, check_same_thread=False, isolation_level=None, timeout=60)
+			self.conn.execute("PRAGMA journal_mode=WAL")
+			self.conn.execute("PRAGMA synchronous=NORMAL")
+			self.conn.execute("CREATE TABLE IF NOT EXISTS calls (day TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+			self.conn.execute("DELETE FROM calls WHERE day < ?", (self.day.isoformat(),))
+	
+	# Make a request with func(*args, **kwargs), retrying it as needed.
+	# Returns the final response.
+	def call(self, func, *args, **kwargs):
+		attempt = 0
+		while True:
+			self._wait()
+			try:
+				response = func(*args, **kwargs)
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+				if attempt >= self.retries:
+					raise
+				time.sleep(self._backoff(attempt))
+			else:
+				if (response.status_code not in self.statuses) or (attempt >= self.retries):
+					return response
+				# Only being told to slow down holds back every worker; any other
+				# failure just makes this worker wait before trying again.
+				delay = self._retryAfter(response)
+				if (delay != None) or (response.status_code == 429):
+					if delay == None:
+						delay = self._backoff(attempt)
+					self._pause(delay)
+				else:
+					time.sleep(self._backoff(attempt))
+			attempt += 1
+	
+	# Waits for a slot for a request made outside of call() (such as a
+	# hedged GET), counting it against the daily budget.
+	def reserve(self):
+		self._wait()
+	
+	# Block until this request's slot comes up, counting it against the
+	# daily budget.
+	def _wait(self):
+		with self.lock:
+			today = datetime.date.today()
+			if today != self.day:
+				self.day = today
+				self.calls = 0
+			if self.conn != None:
+				self.calls = self._countCall(today.isoformat())
+			else:
+				self.calls += 1
+			if (self.budget != None) and (self.calls > self.budget):
+				raise BudgetExhaustedError("Daily budget of " + str(self.budget) + " calls used up")
+			
+			now = time.monotonic()
+			slot = max(now, self.next_slot)
+			self.next_slot = slot + self.interval
+		if slot > now:
+			time.sleep(slot - now)
+	
+	# Returns the day's count in the count file including this call, which is
+	# only recorded if it fits in the budget. The read and write are one
+	# transaction, so processes sharing the file can't both take the last call.
+	def _countCall(self, day):
+		self.conn.execute("BEGIN IMMEDIATE")
+		try:
+			found = self.conn.execute("SELECT count FROM calls WHERE day = ?", (day,)).fetchone()
+			calls = (0 if found == None else found[0]) + 1
+			if (self.budget == None) or (calls <= self.budget):
+				self.conn.execute("INSERT OR REPLACE INTO calls VALUES (?, ?)", (day, calls))
+			return calls
+		finally:
+			self.conn.execute("COMMIT")
+	
+	def close(self):
+		if self.conn != None:
+			self.conn.close()
+	
+	# Hold back every worker for the given number of seconds. The waiting
+	# worker takes the first slot once the pause is over.
+	def _pause(self, delay):
+		with self.lock:
+			self.next_slot = max(self.next_slot, time.monotonic() + delay)
+	
+	# "Full jitter" exponential backoff: a random wait of up to
+	# backoff * 2^attempt seconds, so retrying workers don't all come back
+	# at the same moment.
+	def _backoff(self, attempt):
+		return random.uniform(0, self.backoff * (2 ** attempt))
+	
+	# Retry-After can either be a number of seconds or an HTTP date.
+	def _retryAfter(self, response):
+		value = response.headers.get('Retry-After')
+		if value == None:
+			return None
+		try:
+			return max(0.0, float(value))
+		except ValueError:
+			try:
+				when = email.utils.parsedate_to_datetime(value)
+			except (TypeError, ValueError):
+				return None
+			return max(0.0, when.timestamp() - time.time())
+
+class BudgetExhaustedError(Exception):
+	pass
+
+"""ProgressJournal
+		An append-only record of the items update() has finished, kept as
+		"status,barcode" lines and flushed as soon as each item completes. When
+		resuming, items whose latest entry is 'success' or 'unchanged' are
+		treated as done. Otherwise the journal is started afresh.
+"""
+class ProgressJournal:
+
+	def __init__(self, filename, resume=False):
+		self.done = set()
+		if resume and os.path.exists(filename):
+			with open(filename, 'r') as file:
+				for line in file:
+					(status, sep, barcode) = line.rstrip('\n').partition(',')
+					if status in ('success', 'unchanged'):
+						self.done.add(barcode)
+					else:
+						self.done.discard(barcode)
+			print("Resuming: " + str(len(self.done)) + " items already updated")
+		
+		self.lock = threading.Lock()
+		self.file = open(filename, ('w','a')[resume])
+	
+	def isDone(self, barcode):
+		return barcode in self.done
+	
+	def record(self, barcode, status):
+		with self.lock:
+			self.file.write(status + "," + barcode + "\n")
+			self.file.flush()
+	
+	def close(self):
+		self.file.close()
+
+"""Metrics
+		Records where a run spends its time, to be saved as a JSON report at
+		the end. For each stage (reading, checking columns, parsing
+		descriptions, sorting, the tests, writing, updating...) it keeps the
+		wall time, CPU time and number of rows; for each request to Alma, its
+		latency and status code. It also counts the items matched by each
+		description pattern and the outcome of each item updated.
+		
+		Stages are timed with 'with metrics.stage(name):'. A stage that runs
+		more than once (e.g. once per title) adds up. Stages streamed through
+		another (such as the split stages in --pipeline mode) overlap it, and
+		CPU time is that of the thread running the stage. Can be shared
+		between threads.
+"""
+class Metrics:
+	
+	# Upper bounds of the latency histogram's buckets, in milliseconds.
+	latency_buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.cpu_started = time.process_time()
+		self.stages = {}
+		self.latencies = {}
+		self.recent = {}
+		self.statuses = collections.Counter()
+		self.patterns = collections.Counter()
+		self.items = collections.Counter()
+		self.events = collections.Counter()
+	
+	@contextlib.contextmanager
+	def stage(self, name, rows=0):
+		wall = time.perf_counter()
+		cpu = time.thread_time()
+		try:
+			yield
+		finally:
+			self.addStage(name, time.perf_counter() - wall, time.thread_time() - cpu, rows)
+	
+	def addStage(self, name, wall, cpu, rows=0, runs=1):
+		with self.lock:
+			totals = self.stages.setdefault(name, [0.0, 0.0, 0, 0])
+			totals[0] += wall
+			totals[1] += cpu
+			totals[2] += rows
+			totals[3] += runs
+	
+	def addRows(self, name, rows):
+		self.addStage(name, 0.0, 0.0, rows, 0)
+	
+	def addRequest(self, method, seconds, status):
+		with self.lock:
+			self.latencies.setdefault(method, array.array('d')).append(seconds)
+			self.recent.setdefault(method, collections.deque(maxlen=hedge_window)).append(seconds)
+			self.statuses[method + " " + str(status)] += 1
+	
+	def addPatterns(self, patterns):
+		counts = collections.Counter(patterns)
+		with self.lock:
+			self.patterns.update(counts)
+	
+	def addItem(self, status):
+		with self.lock:
+			self.items[status] += 1
+	
+	# Counts anything else worth knowing about, e.g. hedged requests.
+	def addEvent(self, name):
+		with self.lock:
+			self.events[name] += 1
+	
+	# Returns the p'th percentile of the latest (up to hedge_window) latencies
+	# of a kind of request, in seconds, or None if there have been fewer than
+	# 'least'. Only copying them is done while holding the lock, so sorting
+	# them doesn't hold up the requests being recorded.
+	def recentPercentile(self, method, p, least=1):
+		with self.lock:
+			latencies = list(self.recent.get(method, ()))
+		if len(latencies) < least:
+			return None
+		return self._percentile(sorted(latencies), p)
+	
+	@staticmethod
+	def _percentile(latencies, p):
+		if not latencies:
+			return None
+		return latencies[min(len(latencies)-1, int(len(latencies) * p / 100))]
+	
+	# Everything recorded, as plain data that can be sent between processes
+	# and added to another Metrics with merge().
+	def snapshot(self):
+		with self.lock:
+			return {'stages': {name: list(totals) for (name, totals) in self.stages.items()},
+				'latencies': {method: list(values) for (method, values) in self.latencies.items()},
+				'statuses': dict(self.statuses),
+				'patterns': dict(self.patterns),
+				'items': dict(self.items),
+				'events': dict(self.events)}
+	
+	def merge(self, snapshot):
+		for (name, totals) in snapshot['stages'].items():
+			self.addStage(name, *totals)
+		with self.lock:
+			for (method, values) in snapshot['latencies'].items():
+				self.latencies.setdefault(method, array.array('d')).extend(values)
+			self.statuses.update(snapshot['statuses'])
+			self.patterns.update(snapshot['patterns'])
+			self.items.update(snapshot['items'])
+			self.events.update(snapshot['events'])
+	
+	def report(self):
+		stages = {}
+		for (name, (wall, cpu, rows, runs)) in self.snapshot()['stages'].items():
+			stages[name] = {'wall_seconds': round(wall, 4), 'cpu_seconds': round(cpu, 4), 'runs': runs, 'rows': rows,
+				'rows_per_second': (round(rows / wall, 1) if (rows and wall) else None)}
+		
+		requests_made = {}
+		for method in sorted(self.latencies):
+			with self.lock:
+				latencies = sorted(self.latencies[method])
+			histogram = collections.OrderedDict()
+			for bound in self.latency_buckets:
+				histogram['<=' + str(bound)] = 0
+			histogram['>' + str(self.latency_buckets[-1])] = 0
+			for seconds in latencies:
+				ms = seconds * 1000
+				bucket = next((bound for bound in self.latency_buckets if ms <= bound), None)
+				histogram[('>' + str(self.latency_buckets[-1])) if bucket == None else ('<=' + str(bucket))] += 1
+			requests_made[method] = {'count': len(latencies),
+				'mean_ms': round(1000 * sum(latencies) / len(latencies), 2),
+				'p50_ms': round(1000 * self._percentile(latencies, 50), 2),
+				'p95_ms': round(1000 * self._percentile(latencies, 95), 2),
+				'p99_ms': round(1000 * self._percentile(latencies, 99), 2),
+				'max_ms': round(1000 * latencies[-1], 2),
+				'histogram_ms': histogram}
+		
+		with self.lock:
+			return {'stages': stages,
+				'requests': requests_made,
+				'status_codes': dict(sorted(self.statuses.items())),
+				'patterns': dict(self.patterns.most_common()),
+				'items': dict(self.items),
+				'events': dict(self.events)}
+	
+	def save(self, filename, input_filename, flags):
+		report = {'input': input_filename,
+			'flags': flags,
+			'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+			'wall_seconds': round(time.time() - self.started, 4),
+			'cpu_seconds': round(time.process_time() - self.cpu_started, 4)}
+		report.update(self.report())
+		with open(filename, 'w') as output:
+			json.dump(report, output, indent=2)
+
+# The metrics for this run.
+metrics = Metrics()
+
+"""_orderedMap(pool, func, items, window)
+		Runs func over items using the given executor, keeping no more than
+		'window' items in flight at a time. Results are yielded in the same
+		order as the input items no matter which finishes first. If it is
+		closed early, items that haven't started are dropped, and it waits for
+		the ones that have to finish (as the executor may go on being used).
+"""
+def _orderedMap(pool, func, items, window):
+	pending = collections.deque()
+	try:
+		for item in items:
+			pending.append(pool.submit(func, item))
+			if len(pending) >= window:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+	finally:
+		for future in pending:
+			future.cancel()
+		concurrent.futures.wait(pending)
 	
 """_checkColumns(data, mand, opt, add)
 		Verifies columns exist within a data set. The columns are classified as
@@ -681,139 +2371,560 @@ def _checkValue(colname, value, msg):
 	# Out of loop means a valid value was found
 	return value
 	
+# This is the list of patterns used when processing descriptions.  Use a
+# (name, pattern, prefilter) tuple when adding to the list.  Order matters -
+# keep the broadest patterns at the beginning of the list and append more
+# specific, irregular, or uncommon patterns to the end. The prefilter is a
+# set of cheap patterns that must all be found somewhere in a description
+# for the full pattern to possibly match it (e.g. every pattern needs a 'V'
+# for the volume); descriptions are only tried against the patterns whose
+# prefilters pass, which saves the costly backtracking of the full patterns
+# on descriptions they could never match.
+""" TODO: Determine what to do when primary enumeration is year instead of
+		volume
+	TODO: Add patterns for exact date descriptions. 
+	TODO: Add optional pre-volume capturing group within volume information
+		somehow (e.g. ser3 v2 ...)
+"""
+descPatternStrings = [("StdMatch",'^\s*(?P<enumAType>(?:SER\.?\s*\d+\s*)?VO?L?\s*[\.:]?\s?)\s*(?P<enumANum>\d+[-/]?\d*)\s*(?P<enumB>(?:(?:\s+NO?S?|\s+P[PTG]?)\s*\.?\s*\d+[-/]?\d*)*)\s*(?:\(?\s*(?P<chronJ>(?:(?:JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\.?\s*[-/]?\s*){0,2})\s*(?P<chronI>(?<!\d)\d{2,4}(?:[-/]\d{1,4})?)\s*\)?)?[ \t]*$', ('V',)),
+
+("YearBeforeMonth",'^\s*(?P<enumAType>(?:SER\.?\s*\d+\s*)?VO?L?\s*[\.:]?\s?)\s*(?P<enumANum>\d+[-/]?\d*)\s*(?P<enumB>(?:(?:\s+NO?S?|\s+P[PTG]?)\s*\.?\s*\d+[-/]?\d*)*)\s*\(?\s*(?P<chronI>(?<!\d)\d{4}(?:[-/]\d{1,4})?)\s*(?P<chronJ>(?:(?:JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\.?\s*[-/]?\s*){1,2})\s*\)?[ \t]*$', ('V','\d{4}')),
+
+("SplitYears",'^\s*(?P<enumAType>(?:SER\.?\s*\d+\s*)?VO?L?\s*[\.:]?\s?)\s*(?P<enumANum>\d+[-/]?\d*)\s*(?P<enumB>(?:(?:\s+NO?S?|\s+P[PTG]?)\s*\.?\s*\d+[-/]?\d*)*)\s*\(?\s*(?P<chronJpt1>JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\s*(?P<chronIpt1>(?<!\d)\d{2,4})\s*[-/]\s*(?P<chronJpt2>JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\s*(?P<chronIpt2>(?<!\d)\d{2,4})\s*\)?[ \t]*$', ('V','[-/]'))]
+
+
+# Pattern calls made against this precompiled list of patterns rather
+# than the strings above.
+descPatterns = [(i[0], re.compile(i[1], flags=re.I), [re.compile(f, flags=re.I) for f in i[2]]) for i in descPatternStrings]
+
+# Descriptions repeat a lot across copies and titles, so parsed descriptions
+# are remembered, up to this many distinct strings.
+description_cache_size = 100000
+
 def _matchDescriptions(data, ind):
+	table = ItemTable(data[0], data[1:])
+	before = _parseDescription.cache_info()
+	no_match_count = _matchRows(table, ind)[0]
+	after = _parseDescription.cache_info()
+	_reportMatches(no_match_count, after.hits - before.hits, after.misses - before.misses)
+	return data[:1] + list(table.rowLists())
 
-	# This is the list of patterns used when processing descriptions.  Use a
-	# (name, pattern) tuple when adding to the list.  Order matters - keep
-	# the broadest patterns at the beginning of the list and append more
-	# specific, irregular, or uncommon patterns to the end.
-	""" TODO: Determine what to do when primary enumeration is year instead of
-			volume
-		TODO: Add patterns for exact date descriptions. 
-		TODO: Add optional pre-volume capturing group within volume information
-			somehow (e.g. ser3 v2 ...)
-	"""
-	descPatternStrings = [("StdMatch",'^\s*(?P<enumAType>(?:SER\.?\s*\d+\s*)?VO?L?\s*[\.:]?\s?)\s*(?P<enumANum>\d+[-/]?\d*)\s*(?P<enumB>(?:(?:\s+NO?S?|\s+P[PTG]?)\s*\.?\s*\d+[-/]?\d*)*)\s*(?:\(?\s*(?P<chronJ>(?:(?:JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\.?\s*[-/]?\s*){0,2})\s*(?P<chronI>(?<!\d)\d{2,4}(?:[-/]\d{1,4})?)\s*\)?)?[ \t]*$'),
-	
-	("YearBeforeMonth",'^\s*(?P<enumAType>(?:SER\.?\s*\d+\s*)?VO?L?\s*[\.:]?\s?)\s*(?P<enumANum>\d+[-/]?\d*)\s*(?P<enumB>(?:(?:\s+NO?S?|\s+P[PTG]?)\s*\.?\s*\d+[-/]?\d*)*)\s*\(?\s*(?P<chronI>(?<!\d)\d{4}(?:[-/]\d{1,4})?)\s*(?P<chronJ>(?:(?:JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\.?\s*[-/]?\s*){1,2})\s*\)?[ \t]*$'),
-	
-	("SplitYears",'^\s*(?P<enumAType>(?:SER\.?\s*\d+\s*)?VO?L?\s*[\.:]?\s?)\s*(?P<enumANum>\d+[-/]?\d*)\s*(?P<enumB>(?:(?:\s+NO?S?|\s+P[PTG]?)\s*\.?\s*\d+[-/]?\d*)*)\s*\(?\s*(?P<chronJpt1>JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\s*(?P<chronIpt1>(?<!\d)\d{2,4})\s*[-/]\s*(?P<chronJpt2>JAN?[A-Z]*|FE[A-Z]*|MA?R[CH]*|AP[RIL]*|MA?Y|JU?[NE]E?|JU?[LY]Y?|AU?G[UST]*|SE[PTEMBR]*|O[A-Z]*|NO?V[A-Z]*|D[A-Z]*|SP[RING]*|SU[MER]*|AUT[UMN]*|FA[L]*|W[A-Z]*)\s*(?P<chronIpt2>(?<!\d)\d{2,4})\s*\)?[ \t]*$')]
-	
-	# Pattern calls made against this precompiled list of patterns rather
-	# than the strings above.
-	p = [(i[0],re.compile(i[1], flags=re.I)) for i in descPatternStrings]
-
-	# Test the description of each item sequentially against the regex
-	# pattern list.  Record the name of the matched pattern, unless none is
-	# found 
+# Test the description of each row of an ItemTable against the regex pattern
+# list.  Record the name of the matched pattern, unless none is found.
+# Returns the number of descriptions that didn't match, and every row's
+# volume numbers for sorting. Shows how far it has got on 'progress', if given.
+def _matchRows(table, ind, progress=None):
 	no_match_count = 0
-	for row in data[1:]:
-		for i in p:
-			result = i[1].match(row[ind["Description"]])
-			if result != None:
-				# Match found, record the groups of information and the
-				# pattern that matched. Check each for existence and replace
-				# with empty string if not found.
-				"""TODO: Handle this assignment more elegantly."""
-				
-				named_groups = result.groupdict()
-				
-				#Enum A
-				if 'enumAType' in named_groups and result.group('enumAType') != None:
-					row[ind["Enum A"]] = result.group('enumAType')
-				if 'enumANum' in named_groups and result.group('enumANum') != None:
-					row[ind["Enum A"]] += result.group('enumANum')
-				#Enum B
-				if 'enumB' in named_groups and result.group('enumB') != None:
-					row[ind["Enum B"]] = result.group('enumB').strip()
-				#Chron I
-				if 'chronI' in named_groups and result.group('chronI') != None:
-					row[ind["Chron I"]] = result.group('chronI')
-				else:
-					if 'chronIpt1' in named_groups and result.group('chronIpt1') != None:
-						row[ind["Chron I"]] = result.group('chronIpt1')
-					if 'chronIpt2' in named_groups and result.group('chronIpt2') != None:
-						row[ind["Chron I"]] += "-" + result.group('chronIpt2')
-				#Chron J
-				if 'chronJ' in named_groups and result.group('chronJ') != None:
-					row[ind["Chron J"]] = result.group('chronJ')
-				else:
-					if 'chronJpt1' in named_groups and result.group('chronJpt1') != None:
-						row[ind["Chron J"]] = result.group('chronJpt1')
-					if 'chronJpt2' in named_groups and result.group('chronJpt2') != None:
-						row[ind["Chron J"]] += "-" + result.group('chronJpt2')
-				#Pattern	
-				row[ind["Pattern"]] = i[0]
-				break
-				
-		else: # -> No match was found using the list of patterns.
-				row[ind["Pattern"]] = "N/A"
-				no_match_count += 1
-	
-	# Alert user of the number of non-matching/errors found.
+	volumes = []
+	descriptions = table.columns[ind["Description"]]
+	enumAs = table.columns[ind["Enum A"]]
+	enumBs = table.columns[ind["Enum B"]]
+	chronIs = table.columns[ind["Chron I"]]
+	chronJs = table.columns[ind["Chron J"]]
+	patterns = table.columns[ind["Pattern"]]
+	for i in range(len(table)):
+		(enumA, enumB, chronI, chronJ, pattern, volume) = _parseDescription(descriptions[i])
+		volumes.append(volume)
+		
+		# Only the information a pattern actually found is recorded, anything
+		# else is left as it was.
+		if enumA != None:
+			enumAs[i] = enumA
+		if enumB != None:
+			enumBs[i] = enumB
+		if chronI != None:
+			chronIs[i] = chronI
+		if chronJ != None:
+			chronJs[i] = chronJ
+		patterns[i] = pattern
+		if pattern == "N/A": # -> No match was found using the list of patterns.
+			no_match_count += 1
+		if progress != None:
+			progress.advance()
+	metrics.addPatterns(patterns)
+	return (no_match_count, volumes)
+
+# Alert user of the number of non-matching/errors found.
+def _reportMatches(no_match_count, hits, misses):
 	if no_match_count == 0:
 		print("All item descriptions parsed successfully")
 	else:
 		print ("Could not parse " + str(no_match_count) + " item description" +
 		("","s")[no_match_count > 1])
+	print("Description cache: " + str(hits) + " hits, " + str(misses) + " misses")
+
+"""_parseDescription(description)
+		Runs a description through the pattern list, returning an
+		(Enum A, Enum B, Chron I, Chron J, pattern name, volume) tuple. Any
+		piece of information the matching pattern didn't find is None, and the
+		pattern name is "N/A" when nothing matched. The volume is the
+		(pre-volume, volume) pair from _volumeKey that items are sorted by.
+		Results are cached by description.
+"""
+@functools.lru_cache(maxsize=description_cache_size)
+def _parseDescription(description):
+	enumA = enumB = chronI = chronJ = None
 	
-	return data
+	for (name, pattern, prefilter) in descPatterns:
+		# Skip patterns that can't possibly match.
+		if not all(f.search(description) for f in prefilter):
+			continue
+		
+		result = pattern.match(description)
+		if result != None:
+			# Match found, record the groups of information and the
+			# pattern that matched. Check each for existence and leave it
+			# as None if not found.
+			named_groups = result.groupdict()
+			
+			#Enum A
+			if named_groups.get('enumAType') != None:
+				enumA = named_groups['enumAType']
+			if named_groups.get('enumANum') != None:
+				enumA = (enumA or '') + named_groups['enumANum']
+			#Enum B
+			if named_groups.get('enumB') != None:
+				enumB = named_groups['enumB'].strip()
+			#Chron I
+			if named_groups.get('chronI') != None:
+				chronI = named_groups['chronI']
+			else:
+				if named_groups.get('chronIpt1') != None:
+					chronI = named_groups['chronIpt1']
+				if named_groups.get('chronIpt2') != None:
+					chronI = (chronI or '') + "-" + named_groups['chronIpt2']
+			#Chron J
+			if named_groups.get('chronJ') != None:
+				chronJ = named_groups['chronJ']
+			else:
+				if named_groups.get('chronJpt1') != None:
+					chronJ = named_groups['chronJpt1']
+				if named_groups.get('chronJpt2') != None:
+					chronJ = (chronJ or '') + "-" + named_groups['chronJpt2']
+			return (enumA, enumB, chronI, chronJ, name, _volumeKey(description))
+	
+	return (enumA, enumB, chronI, chronJ, "N/A", _volumeKey(description))
 
 def _readFile(filename):
 	
-	try:
-		file = open(filename,"r")
-	except IOError:
-		print("file not found")
-		sys.exit(1)
-		
-	data = []
 	# Read the file into useable data
-	for eachline in file:
-		eachline = eachline.strip() #remove the newline character from the end
-		a = eachline.split(",")
-		data.append(a)
+	rows = _iterFile(filename)
+	return ItemTable(next(rows), rows)
+
+# Reads a file one row at a time, as lists of strings.
+def _iterFile(filename):
+	reader = MappedCsv(filename)
+	for row in reader.iterRows():
+		yield row
+	reader.close()
+
+# The characters that matter when following quotes through a CSV row, and
+# a whole row (a line, or the rest of one) whose quoted fields all end
+# within it, for the common case.
+csv_specials = re.compile(b'[",]')
+csv_quoted = rb'"(?:[^"]|"")*"(?!")[^,]*'
+csv_closed_row = re.compile(rb'\s*(?:' + csv_quoted + rb'|[^",\s][^,]*|)(?:,(?:' + csv_quoted + rb'|[^",][^,]*|))*')
+
+"""MappedCsv(filename)
+		Reads a CSV file through a memory map rather than loading it. Opening
+		the file makes a single pass over it to find where each row starts and
+		ends (quoted fields may hold commas, and even newlines), but fields
+		aren't turned into strings until a row is read. Rows can be read by
+		index (reader[i], the header being reader[0]) or streamed with
+		iterRows(), which can also pick out just the columns wanted. As with
+		any CSV read here, each row has surrounding whitespace removed.
+"""
+class MappedCsv:
+
+	def __init__(self, filename):
+		try:
+			self.file = open(filename, 'rb')
+		except IOError:
+			print("file not found")
+			sys.exit(1)
+		
+		# Empty files can't be mapped.
+		if os.fstat(self.file.fileno()).st_size == 0:
+			self.map = b''
+		else:
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		
+		# Skip any byte order mark left by the program that saved the file.
+		start = 0
+		if csv_encoding.lower().replace('-','').replace('_','') in ('utf8', 'utf8sig') and self.map[:3] == b'\xef\xbb\xbf':
+			start = 3
+		
+		self.quoted = (self.map.find(b'"', start) != -1)
+		self.starts = array.array('Q')
+		self.ends = array.array('Q')
+		self._findRows(start)
+	
+	# Record the start and end of every row. A newline only ends a row if it
+	# isn't inside a quoted field. Files without any quotes don't need to be
+	# checked, and neither do lines without any quotes outside of a quoted
+	# field.
+	def _findRows(self, pos):
+		size = len(self.map)
+		row_start = pos
+		in_quotes = False
+		while pos < size:
+			newline = self.map.find(b'\n', pos)
+			if newline == -1:
+				newline = size
+			if self.quoted and (in_quotes or (self.map.find(b'"', pos, newline) != -1)):
+				if in_quotes or not csv_closed_row.fullmatch(self.map, pos, newline):
+					in_quotes = self._scanQuotes(pos, newline, in_quotes, pos == row_start)
+			if not in_quotes:
+				self.starts.append(row_start)
+				self.ends.append(newline)
+				row_start = newline + 1
+			pos = newline + 1
+		
+		# An unfinished quote runs to the end of the file.
+		if row_start < size:
+			self.starts.append(row_start)
+			self.ends.append(size)
+	
+	# Follows the quotes in a line the way the csv module reads them: a quote
+	# only starts a quoted field at the very start of a field (leading
+	# whitespace aside at the start of a row, as rows are stripped), "" inside
+	# a quoted field is a quote, and any other quote is just a character.
+	# Returns whether the line ends inside a quoted field.
+	def _scanQuotes(self, pos, end, in_quotes, row_start):
+		field_start = pos
+		if row_start:
+			while (field_start < end) and self.map[field_start:field_start+1].isspace():
+				field_start += 1
+		skip = -1
+		for match in csv_specials.finditer(self.map, pos, end):
+			at = match.start()
+			if at <= skip:
+				continue
+			if in_quotes:
+				if self.map[at] != ord('"'):
+					continue
+				if self.map[at+1:at+2] == b'"':
+					skip = at + 1
+				else:
+					in_quotes = False
+			elif self.map[at] == ord(','):
+				field_start = at + 1
+			elif at == field_start:
+				in_quotes = True
+		return in_quotes
+	
+	def __len__(self):
+		return len(self.starts)
+	
+	def __getitem__(self, i):
+		return self._fields(i, None)
+	
+	# Streams rows from 'start' onwards. If columns (a list of indexes) is
+	# given, each row only holds those fields, in that order, with blanks for
+	# any the row is too short to have.
+	def iterRows(self, start=0, columns=None):
+		for i in range(start, len(self.starts)):
+			yield self._fields(i, columns)
+	
+	def _fields(self, i, columns):
+		line = self.map[self.starts[i]:self.ends[i]].strip()
+		if self.quoted and (b'"' in line):
+			records = csv.reader(io.StringIO(line.decode(csv_encoding), newline=''))
+			fields = next(records)
+			if next(records, None) != None:
+				raise csv.Error("Row " + str(i+1) + " of the file holds more than one row's worth of data")
+			if columns == None:
+				return fields
+			return [(fields[c] if c < len(fields) else "") for c in columns]
+		
+		if columns == None:
+			return line.decode(csv_encoding).split(',')
+		fields = line.split(b',')
+		width = len(fields)
+		return [(fields[c].decode(csv_encoding) if c < width else "") for c in columns]
 	
-	# Done reading file, close it.
-	file.close()
+	def close(self):
+		if isinstance(self.map, mmap.mmap):
+			self.map.close()
+		self.file.close()
+		
+"""ItemTable(header, rows=())
+		A table of items held a column at a time, as one list per column, rather
+		than as a list for every row. Columns are added in one step however
+		many rows there are, and each step of the program can run down just
+		the columns it works on. Values in the interned_columns are interned,
+		so only one copy of each distinct value is kept. Rows are cut or padded
+		with blanks to the header's width as they are added.
+		
+		table[i] gives an ItemRow, a view of a single row that can be indexed
+		like a list, and rowLists() gives the rows back as lists (not including
+		the header) for writing out.
+"""
+class ItemTable:
+
+	def __init__(self, header, rows=()):
+		self.header = list(header)
+		self.columns = [[] for col in self.header]
+		self.interned = [(col in interned_columns) for col in self.header]
+		self.extend(rows)
+	
+	def __len__(self):
+		return len(self.columns[0]) if self.columns else 0
+	
+	def __getitem__(self, i):
+		return ItemRow(self, i)
+	
+	def __iter__(self):
+		for i in range(len(self)):
+			yield ItemRow(self, i)
+	
+	# Adds rows to the end of the table. Rows are taken a chunk at a time and
+	# turned into columns all at once, so a stream of rows is never held in
+	# memory as rows.
+	def extend(self, rows):
+		width = len(self.header)
+		rows = iter(rows)
+		while True:
+			chunk = list(itertools.islice(rows, 10000))
+			if not chunk:
+				break
+			for i in range(len(chunk)):
+				if len(chunk[i]) != width:
+					chunk[i] = (list(chunk[i]) + [""] * width)[:width]
+			for (column, interned, values) in zip(self.columns, self.interned, zip(*chunk)):
+				if interned:
+					column.extend(map(sys.intern, values))
+				else:
+					column.extend(values)
+	
+	def append(self, row):
+		self.extend((row,))
+	
+	# Adds another table's rows (with the same columns) to the end of this one.
+	def extendTable(self, other):
+		for (column, values) in zip(self.columns, other.columns):
+			column.extend(values)
+	
+	# Adds a column filled with 'value', returning its index.
+	def addColumn(self, name, value=""):
+		self.columns.append([value] * len(self))
+		self.header.append(name)
+		self.interned.append(name in interned_columns)
+		return len(self.header) - 1
+	
+	# Puts the rows in the order given by a list of row indexes.
+	def reorder(self, order):
+		self.columns = [[column[i] for i in order] for column in self.columns]
+	
+	# Returns a new table of the rows at the given indexes.
+	def take(self, indexes):
+		table = ItemTable(self.header)
+		table.columns = [[column[i] for i in indexes] for column in self.columns]
+		return table
+	
+	def rowLists(self):
+		return map(list, zip(*self.columns))
+
+# A single row of an ItemTable, indexed the same way as a row list.
+class ItemRow:
+	__slots__ = ('table', 'index')
+	
+	def __init__(self, table, index):
+		self.table = table
+		self.index = index
+	
+	def __getitem__(self, col):
+		return self.table.columns[col][self.index]
+	
+	def __setitem__(self, col, value):
+		self.table.columns[col][self.index] = value
+	
+	def __len__(self):
+		return len(self.table.columns)
+	
+	def __iter__(self):
+		for column in self.table.columns:
+			yield column[self.index]
+	
+"""Progress(stage, total=None, every=1)
+		Shows how a stage is getting on: how many items are done (of how many,
+		if the total is known), how many had each outcome, how many items a
+		second are currently being done and roughly how long is left. Rather
+		than printing for every item, the display is refreshed at most every
+		progress_interval seconds, and the clock is only checked every
+		'every' items so that fast stages aren't slowed down. In a terminal
+		the display is redrawn on one line; anywhere else (e.g. a log file) a
+		line is printed each time. Nothing is shown in quiet mode.
+"""
+class Progress:
+	
+	def __init__(self, stage, total=None, every=1):
+		self.stage = stage
+		self.total = total
+		self.every = every
+		self.done = 0
+		self.counts = collections.OrderedDict()
+		self.enabled = (not quiet) and bool(progress_interval)
+		self.inline = self.enabled and sys.stdout.isatty()
+		self.unchecked = 0
+		self.started = time.monotonic()
+		self.last_time = self.started
+		self.last_done = 0
+		self.rate = None
+		self.shown = False
+	
+	# Counts 'count' more items as done, under 'status' if one is given.
+	def advance(self, count=1, status=None):
+		self.done += count
+		if status != None:
+			self.counts[status] = self.counts.get(status, 0) + count
+		self.unchecked += count
+		if self.enabled and (self.unchecked >= self.every):
+			self.unchecked = 0
+			now = time.monotonic()
+			if now - self.last_time >= progress_interval:
+				self._update(now)
+				self._show()
+	
+	# Prints a message without it getting mixed up with the display.
+	def message(self, text):
+		if self.inline and self.shown:
+			sys.stdout.write("\r\033[K")
+		print(text)
+		if self.inline and self.shown:
+			self._show()
 	
-	return data
+	# Shows the final counts (if anything was shown before) and moves on.
+	def close(self):
+		if self.enabled and self.shown:
+			self._update(time.monotonic(), final=True)
+			self._show()
+			if self.inline:
+				sys.stdout.write("\n")
+			self.shown = False
+			self.enabled = False
+	
+	# The current rate is smoothed so the ETA doesn't jump about, and at the
+	# end is replaced by the average over the whole stage.
+	def _update(self, now, final=False):
+		if final:
+			self.rate = self.done / max(now - self.started, 1e-9)
+		else:
+			rate = (self.done - self.last_done) / max(now - self.last_time, 1e-9)
+			if self.rate == None:
+				self.rate = rate
+			else:
+				self.rate = 0.3*rate + 0.7*self.rate
+		self.last_time = now
+		self.last_done = self.done
+	
+	def _show(self):
+		line = self.stage + ": " + "{:,}".format(self.done)
+		if self.total:
+			line += " of " + "{:,}".format(self.total) + " (" + str(int(100 * self.done / self.total)) + "%)"
+		if self.counts:
+			line += " - " + ", ".join("{:,}".format(count) + " " + status for (status, count) in self.counts.items())
+		if self.rate != None:
+			line += " - " + str(round(self.rate, (1 if self.rate < 100 else None))) + " items/s"
+			if self.total and self.rate > 0 and self.done < self.total:
+				seconds = int((self.total - self.done) / self.rate)
+				line += " - ETA " + str(datetime.timedelta(seconds=seconds))
+		if self.inline:
+			sys.stdout.write("\r\033[K" + line)
+			sys.stdout.flush()
+		else:
+			print(line)
+		self.shown = True
+
+def _writeTo(prefix, source, data):
+	
+	output = CsvOutput(prefix, source)
+	output.writeRows(data)
+	output.close()
+	return output.filename
+
+# Writes rows to a new file as they stream past, handing each one on.
+def _teeTo(prefix, source, data):
+	
+	output = CsvOutput(prefix, source)
+	for row in data:
+		output.write(row)
+		yield row
+	output.close()
+
+"""CsvOutput(prefix, source)
+		An output file next to the input file ('source'), named using the
+		input file's name and the given prefix, that rows can be written to
+		one at a time. Rows are encoded by the csv
+		module, so fields holding commas or quotes are quoted properly, and go
+		through a large write buffer that is flushed every so often (see
+		output_buffer_size and output_flush_interval). Any number of outputs
+		can be open at once.
+"""
+class CsvOutput:
+
+	def __init__(self, prefix, source):
+		self.prefix = prefix
+		self.filename = _outputName(prefix, source)
+		self.file = open(self.filename, 'w', newline='', buffering=output_buffer_size, encoding=csv_encoding)
+		self.writer = csv.writer(self.file, lineterminator='\n')
+		self.next_flush = time.monotonic() + output_flush_interval
+		self.unchecked = 0
+		self.rows = 0
+	
+	def write(self, row):
+		# Most rows have nothing that needs quoting, and joining them is much
+		# quicker than the csv module. Rows that do are left to the csv module.
+		line = ",".join(row)
+		if (line.count(",") == len(row)-1) and ('"' not in line) and ('\n' not in line) and ('\r' not in line):
+			self.file.write(line + "\n")
+		else:
+			self.writer.writerow(row)
 		
-def _writeTo(prefix, data):
+		# Checking the clock on every row would cost more than the write.
+		self.rows += 1
+		self.unchecked += 1
+		if self.unchecked >= 1000:
+			self._flushIfDue()
+	
+	def writeRows(self, rows):
+		for row in rows:
+			self.write(row)
+	
+	def _flushIfDue(self):
+		self.unchecked = 0
+		if time.monotonic() >= self.next_flush:
+			self.file.flush()
+			self.next_flush = time.monotonic() + output_flush_interval
+	
+	def close(self):
+		if self.file.closed:
+			return
+		self.file.close()
+		
+		# Choose an appropriate message to display depending on the input
+		# prefix.
+		if self.prefix == 'f_':
+			message = "Formatted data written to file "
+		elif self.prefix == 's_':
+			message = "Pattern-matched data written to file "
+		else:
+			message = "File written at "
+			
+		print(message + self.filename + "\n")
+	
+# Builds the name of an output file from the input file's name and a prefix.
+# The output goes in the same folder as the input.
+def _outputName(prefix, source):
 	
 	# Remove previous prefixes from the filename to prevent prefix buildup over
 	# multiple iterations.
-	old_filename = sys.argv[1]
+	(folder, old_filename) = os.path.split(source)
 	if ('f_' == old_filename[:2]) or ('s_' == old_filename[:2]):
 		old_filename = old_filename[2:]
 	elif('err_' == old_filename[:2]) or ('suc_' == old_filename[:2]):
 		old_filename = old_filename[4:]
-	new_filename = prefix + old_filename
-	output_file = open(new_filename, 'w')
-	
-	# Iterate over the data, left to right, top to bottom, splitting 
-	# values with commas in the output string.
-	for row in data:
-		output_string = ""
-		for item in row:
-			output_string += item + ","
-		output_string = output_string[:-1] #Remove final comma
-		output_string += '\n'
-		output_file.write(output_string)
-	
-	output_file.close()
-	
-	# Choose an appropriate message to display depending on the input
-	# prefix.
-	if prefix == 'f_':
-		message = "Formatted data written to file "
-	elif prefix == 's_':
-		message = "Pattern-matched data written to file "
-	else:
-		message = "File written at "
-		
-	print(message + new_filename + "\n")
-	return new_filename
+	return os.path.join(folder, prefix + old_filename)
 	
 if __name__ == "__main__":
 	main()
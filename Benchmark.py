@@ -0,0 +1,251 @@
+import contextlib	#silencing the stages' output
+import datetime	#dating results
+import io		#somewhere to send the stages' output
+import os		#operating system stuff
+import platform	#recording the python version
+import random	#generating items
+import shutil	#cleaning up generated files
+import sys 		#interpreter functions and variables
+import tempfile	#somewhere to put generated files
+import threading	#running the mock Alma server
+import time		#for timing processes
+
+import BatchUpdate
+import MockAlma
+
+"""Benchmark.py
+	Usage: Benchmark.py rows[,rows...] [--seed=N] [--label=text] [--update] [--option=value]
+	       Benchmark.py rows --generate=filename
+
+	Times each stage of BatchUpdate.py on generated files of the given numbers
+	of items (e.g. 10000,100000,1000000), without touching Alma. The stages
+	timed are:
+		format: format() on the generated file.
+		split: split() on the formatted file.
+		resplit: split() on the same file again, with every title already
+			in the split cache.
+		match: _matchDescriptions on the formatted file, starting with an
+			empty description cache.
+		chron_i: the Chron I "smart guess" on the matched and sorted items.
+		write: _writeTo with the matched items.
+		update: with --update, update() on the split file, against a
+			MockAlma.py server started for the purpose.
+	Results are printed and added to the end of results_file, labelled with
+	--label (e.g. the version being tested) so runs can be compared later.
+
+	Any --option=value that BatchUpdate.py or MockAlma.py takes (e.g.
+	--processes=1, or --rate=0 --limit=0 --latency=0.05 for an update run
+	that isn't held back by Alma's limits) is applied before timing. With --generate, a file of the first size is
+	written instead, for trying the program out on.
+
+	Generated files look like an Alma item export: titles have anywhere from
+	one to a few dozen items, and descriptions come in all of the forms the
+	description patterns handle, along with ones they don't. Some years are
+	only 2 digits (for the Chron I smart guess), and some barcodes are missing
+	or are i-barcodes. The same seed always gives the same file.
+"""
+
+# Where results are saved. Each run adds a row per size and stage.
+results_file = 'benchmark_results.csv'
+
+# Columns of the generated files, in the order Alma exports them.
+columns = ['title','Author','Publisher','MMS ID','Barcode','Description',
+	'Material Type','Item Policy','Location','Call Number','Enum A','Chron I']
+
+# How often each kind of description is generated, as (weight, kind) pairs.
+# 'std', 'yearfirst' and 'splityears' are for the three description
+# patterns, the rest shouldn't match any of them.
+description_mix = [(50, 'std'), (15, 'yearfirst'), (10, 'splityears'),
+	(8, 'volonly'), (7, 'series'), (5, 'index'), (5, 'supplement')]
+
+months = ['Jan','Feb','Mar','Apr','May','June','July','Aug','Sept','Oct','Nov',
+	'Dec','jan.','SEPT.','Spring','Summer','Fall','Winter','Autumn']
+
+def main():
+	if (len(sys.argv) < 2) or not sys.argv[1].replace(',','').isdecimal():
+		print("usage: Benchmark.py rows[,rows...] [--seed=N] [--label=text] [--update] [--generate=filename] [--option=value]")
+		sys.exit(1)
+
+	sizes = [int(size) for size in sys.argv[1].split(',')]
+	flags = sys.argv[2:]
+	settings = {'--seed': '1', '--label': '', '--generate': None}
+	for flag in flags:
+		name, sep, value = flag.partition('=')
+		if sep and (name in settings):
+			settings[name] = value
+	BatchUpdate._applyOptions(flags)
+	MockAlma.port = 0
+	MockAlma._applyOptions(flags)
+	seed = int(settings['--seed'])
+
+	if settings['--generate'] != None:
+		generate(settings['--generate'], sizes[0], seed)
+		print("Generated " + str(sizes[0]) + " items in " + settings['--generate'])
+		return
+
+	results = []
+	for size in sizes:
+		results.extend(benchmark(size, seed, '--update' in flags))
+	_saveResults(results, settings['--label'])
+
+"""generate(filename, rows, seed)
+		Writes a file of 'rows' made up items in the form of an Alma export.
+"""
+def generate(filename, rows, seed):
+	rand = random.Random(seed)
+	kinds = []
+	for (weight, kind) in description_mix:
+		kinds.extend([kind] * weight)
+
+	with open(filename, 'w', encoding=BatchUpdate.csv_encoding) as output:
+		output.write(",".join(columns) + "\n")
+		mms_id = 990000000000000000
+		title = 0
+		written = 0
+		while written < rows:
+			# Titles are runs of items with volumes going up over the years,
+			# though not necessarily in file order.
+			mms_id += rand.randint(1, 10000)
+			title += 1
+			year = rand.randint(1880, 2015)
+			volume = rand.randint(1, 80)
+			items = []
+			for i in range(min(rand.choice([1, 2, 5, 12, 24, 40]), rows - written)):
+				year += rand.choice([0, 1, 1, 2])
+				volume += 1
+				items.append([
+					'Journal of Generated Studies ' + str(title),
+					'Society for Benchmarking',
+					'Example Press',
+					str(mms_id),
+					_barcode(rand),
+					_description(rand, rand.choice(kinds), volume, year),
+					rand.choice(['Bound Issue', 'Issue', 'Book', '']),
+					rand.choice(['non-circulating', 'general circulation', '']),
+					'Stacks',
+					'AP1 .G4' + str(title),
+					'',
+					''])
+			rand.shuffle(items)
+			for item in items:
+				output.write(",".join(item) + "\n")
+			written += len(items)
+
+# Most barcodes are fine, a few are missing or are i-barcodes.
+def _barcode(rand):
+	chance = rand.random()
+	if chance < 0.01:
+		return ''
+	elif chance < 0.04:
+		return 'i' + str(rand.randint(100000, 999999))
+	return '3' + str(rand.randint(10**12, 10**13 - 1))
+
+# Makes up a description of the given kind. About a fifth of years are cut
+# down to 2 digits, the way they often are in real descriptions.
+def _description(rand, kind, volume, year):
+	def yearText(year):
+		if rand.random() < 0.2:
+			return str(year)[2:]
+		return str(year)
+	issue = str(rand.randint(1, 12))
+
+	if kind == 'std':
+		return rand.choice(['v.', 'V.', 'vol.', 'v', 'Vol ']) + str(volume) + rand.choice(['', ' no.' + issue, ' pt.' + issue]) + ' (' + rand.choice(['', rand.choice(months) + ' ']) + yearText(year) + ')'
+	elif kind == 'yearfirst':
+		return 'v.' + str(volume) + ' ' + str(year) + ' ' + rand.choice(months)
+	elif kind == 'splityears':
+		return 'v.' + str(volume) + ' (' + rand.choice(months) + ' ' + yearText(year) + '-' + rand.choice(months) + ' ' + yearText(year+1) + ')'
+	elif kind == 'volonly':
+		return 'v.' + str(volume) + '-' + str(volume+1)
+	elif kind == 'series':
+		return 'ser.' + str(rand.randint(1, 4)) + ' v.' + str(volume) + ' ' + str(year) + ' index'
+	elif kind == 'index':
+		return 'Index ' + str(year) + '-' + str(year+4)
+	return 'Suppl. ' + issue
+
+"""benchmark(rows, seed, updating=False)
+		Generates a file of 'rows' items in a temporary folder and times each
+		stage on it. Returns (rows, stage, seconds) results.
+"""
+def benchmark(rows, seed, updating=False):
+	print("Benchmarking " + str(rows) + " items...")
+	results = []
+	folder = tempfile.mkdtemp()
+	cwd = os.getcwd()
+	os.chdir(folder)
+	try:
+		generate('items.csv', rows, seed)
+
+		formatted = _time(results, rows, 'format', BatchUpdate.format, 'items.csv')
+		BatchUpdate._parseDescription.cache_clear()
+		split = _time(results, rows, 'split', BatchUpdate.split, formatted)
+		_time(results, rows, 'resplit', BatchUpdate.split, formatted)
+
+		# The remaining stages are timed on their own, so their input is set
+		# up the same way split() would.
+		table = BatchUpdate._readFile(formatted)
+		with contextlib.redirect_stdout(io.StringIO()):
+			(header, ind, fills) = BatchUpdate._prepareSplit(list(table.header))
+		data = [header] + list(BatchUpdate.ItemTable(header, table.rowLists()).rowLists())
+		table = None
+
+		BatchUpdate._parseDescription.cache_clear()
+		data = _time(results, rows, 'match', BatchUpdate._matchDescriptions, data, ind)
+
+		table = BatchUpdate.ItemTable(header, data[1:])
+		(no_match_count, keys) = BatchUpdate._parseTable(table, ind)
+		table.reorder(sorted(range(len(table)), key=keys.__getitem__))
+		_time(results, rows, 'chron_i', BatchUpdate._guessChronI, table, ind)
+
+		_time(results, rows, 'write', BatchUpdate._writeTo, 'w_', 'items.csv', data)
+		data = None
+		table = None
+
+		if updating:
+			_benchmarkUpdate(results, rows, split)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(folder)
+	return results
+
+# Times update() on a file against a mock Alma server running in the
+# background. The item cache is turned off so every item is fetched, and the
+# mock's requests aren't counted against the day's real ones.
+def _benchmarkUpdate(results, rows, filename):
+	server = MockAlma.start()
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	settings = (BatchUpdate.alma_api_url, BatchUpdate.item_cache_file, BatchUpdate.call_count_file)
+	BatchUpdate.alma_api_url = MockAlma.apiUrl(server)
+	BatchUpdate.item_cache_file = None
+	BatchUpdate.call_count_file = None
+	try:
+		_time(results, rows, 'update', BatchUpdate.update, filename)
+	finally:
+		(BatchUpdate.alma_api_url, BatchUpdate.item_cache_file, BatchUpdate.call_count_file) = settings
+		server.shutdown()
+		server.server_close()
+	print("    " + MockAlma._statsText(server).replace("\n", ", "))
+
+# Times a single call of func, keeping anything it prints out of the way.
+def _time(results, rows, stage, func, *args):
+	with contextlib.redirect_stdout(io.StringIO()):
+		start = time.perf_counter()
+		result = func(*args)
+		seconds = time.perf_counter() - start
+	print("  " + stage.ljust(8) + str(round(seconds, 3)).rjust(9) + " s" + str(round(rows / seconds)).rjust(11) + " items/s")
+	results.append((rows, stage, seconds))
+	return result
+
+# Adds results to the end of the results file, starting it if needed.
+def _saveResults(results, label):
+	new_file = not os.path.exists(results_file)
+	date = datetime.datetime.now().isoformat(timespec='seconds')
+	with open(results_file, 'a') as output:
+		if new_file:
+			output.write("Date,Label,Python,Rows,Stage,Seconds,Items per second\n")
+		for (rows, stage, seconds) in results:
+			output.write(",".join([date, label.replace(',', ' '), platform.python_version(), str(rows), stage, str(round(seconds, 4)), str(round(rows / seconds))]) + "\n")
+	print("Results added to " + results_file)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,305 @@
+import collections	#tracking recent requests
+import http.server	#serving requests
+import math		#latency distributions
+import random	#latency and made up failures
+import sys 		#interpreter functions and variables
+import threading	#locks shared between request handlers
+import time		#for timing processes
+import urllib.parse	#reading request urls
+import xml.etree.ElementTree as ET	#checking pushed xml
+import zlib		#making up ids from barcodes
+
+"""MockAlma.py
+	Usage: MockAlma.py [--option=value]
+
+	A local stand-in for the parts of the Alma API that BatchUpdate.py uses,
+	for trying out and load testing updates without spending real API calls:
+		GET /almaws/v1/items?item_barcode=...
+			Returns the item with that barcode. Items are made up the first
+			time they are asked for, with ids worked out from the barcode.
+			i-barcodes and barcodes that aren't numbers aren't found, as in
+			Alma.
+		PUT /almaws/v1/bibs/{mms id}/holdings/{holding id}/items/{item id}
+			Replaces an item with the xml sent, and returns it.
+		GET /stats
+			Returns how many requests of each kind have been answered.
+	Every call needs an apikey (any will do). Responses are held back by a
+	made up latency, and some can be made to fail at random. Beyond the rate
+	and daily limits, requests get the same 429 errors Alma sends.
+
+	Start it with e.g. 'python MockAlma.py --port=8080 --latency=0.2' and run
+	BatchUpdate.py with '--api-url=http://localhost:8080/almaws/v1'.
+	Press Ctrl+C to stop it; the request counts are printed on the way out.
+"""
+
+# The port to listen on (0 picks any free port).
+port = 8080
+
+# How long each response is held back, in seconds. latency is the average
+# and latency_spread how much it varies: 'fixed' always waits latency,
+# 'uniform' waits anywhere up to twice as long, 'exponential' mostly waits
+# less than latency but sometimes far longer, and 'lognormal' (the closest
+# to a real server) has most waits near latency with a long tail of slow
+# ones, latency_spread being how long that tail is.
+latency = 0.2
+latency_distribution = 'lognormal'
+latency_spread = 0.5
+
+# The share of requests answered with a 500 or 503 error (error_rate), or
+# with a 429 telling the client to come back after retry_after seconds
+# (throttle_rate).
+error_rate = 0.0
+throttle_rate = 0.0
+retry_after = 1
+
+# Alma's limits on requests per second and per day. None (or 0) for no
+# limit.
+rate_limit = 25
+daily_limit = None
+
+options = {'--port': ('port', int),
+		   '--latency': ('latency', float),
+		   '--distribution': ('latency_distribution', str),
+		   '--spread': ('latency_spread', float),
+		   '--errors': ('error_rate', float),
+		   '--throttle': ('throttle_rate', float),
+		   '--retry-after': ('retry_after', int),
+		   '--limit': ('rate_limit', int),
+		   '--daily': ('daily_limit', int)}
+
+def main():
+	_applyOptions(sys.argv[1:])
+	server = start()
+	print("Mock Alma API running at " + apiUrl(server) + " (Ctrl+C to stop)")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+	print(_statsText(server))
+
+# Overrides the settings above with any --name=value flags (see 'options').
+def _applyOptions(flags):
+	for flag in flags:
+		name, sep, value = flag.partition('=')
+		if sep and (name in options):
+			setting, kind = options[name]
+			globals()[setting] = kind(value)
+
+"""start()
+		Sets up the server on 'port' without starting it. Call
+		serve_forever() on it (in a thread of its own if need be), and
+		shutdown() to stop it.
+"""
+def start():
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MockAlmaHandler)
+	server.daemon_threads = True
+	server.items = {}
+	server.barcodes = {}
+	server.lock = threading.Lock()
+	server.recent = collections.deque()
+	server.stats = collections.Counter()
+	return server
+
+# The base url to give BatchUpdate.py for a running server.
+def apiUrl(server):
+	return 'http://127.0.0.1:' + str(server.server_address[1]) + '/almaws/v1'
+
+def _statsText(server):
+	return "\n".join(name + ": " + str(count) for (name, count) in sorted(server.stats.items()))
+
+"""MockAlmaHandler
+		Answers a single request. The server holds the items and the counts
+		shared between requests.
+"""
+class MockAlmaHandler(http.server.BaseHTTPRequestHandler):
+
+	# Keep connections alive, as Alma does. Without TCP_NODELAY, the body
+	# written after the headers would wait on the client's delayed ACK
+	# (around 40 ms) on every request after the first on a connection.
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		url = urllib.parse.urlparse(self.path)
+		if url.path == '/stats':
+			with self.server.lock:
+				self._send(200, _statsText(self.server), 'text/plain')
+			return
+
+		query = urllib.parse.parse_qs(url.query)
+		if not self._admit('GET', query):
+			return
+		if url.path.rstrip('/') != '/almaws/v1/items' or ('item_barcode' not in query):
+			self._error(400, '402204', 'Invalid request: item_barcode is required')
+			return
+
+		barcode = query['item_barcode'][0]
+		with self.server.lock:
+			item = self.server.items.get(barcode)
+			if (item == None) and barcode.isdecimal():
+				(item_id, item) = _newItem(self._root(), barcode)
+				self.server.items[barcode] = item
+				self.server.barcodes[item_id] = barcode
+		if item == None:
+			self._error(400, '401689', 'No items found for barcode ' + barcode + '.')
+			return
+		self._count('GET 200')
+		self._send(200, item)
+
+	def do_PUT(self):
+		length = int(self.headers.get('Content-Length', 0))
+		body = self.rfile.read(length)
+		url = urllib.parse.urlparse(self.path)
+		if not self._admit('PUT', urllib.parse.parse_qs(url.query)):
+			return
+
+		# Only items that have been fetched can be pushed back, and the xml
+		# sent has to be an item.
+		item_id = url.path.rstrip('/').rsplit('/', 1)[-1]
+		with self.server.lock:
+			barcode = self.server.barcodes.get(item_id)
+		try:
+			root = ET.fromstring(body)
+		except ET.ParseError:
+			root = None
+		if barcode == None:
+			self._error(400, '401690', 'No item found for ' + item_id + '.')
+			return
+		if (root == None) or (root.tag != 'item') or (root.find('item_data') == None):
+			self._error(400, '402203', 'Input is not a valid item.')
+			return
+
+		item = ET.tostring(root, encoding='unicode')
+		with self.server.lock:
+			self.server.items[barcode] = item
+		self._count('PUT 200')
+		self._send(200, item)
+
+	# Does everything a request has in common: checks the api key and the
+	# limits, waits out the latency and makes up failures. Returns whether
+	# the request should go ahead (if not, it has been answered already).
+	def _admit(self, method, query):
+		self._count(method)
+		if not query.get('apikey', [''])[0]:
+			self._error(400, 'UNAUTHORIZED', 'API-key not defined or not configured to allow this API.')
+			return False
+
+		now = time.monotonic()
+		with self.server.lock:
+			recent = self.server.recent
+			while recent and (now - recent[0] > 1):
+				recent.popleft()
+			over_rate = bool(rate_limit) and (len(recent) >= rate_limit)
+			if not over_rate:
+				recent.append(now)
+			over_daily = bool(daily_limit) and (self.server.stats['GET'] + self.server.stats['PUT'] > daily_limit)
+		if over_daily:
+			self._error(429, 'DAILY_THRESHOLD', 'Daily API Request Threshold has been reached.')
+			return False
+		if over_rate:
+			self._error(429, 'PER_SECOND_THRESHOLD', 'HTTP requests are more than allowed per second')
+			return False
+
+		time.sleep(_latency())
+
+		chance = random.random()
+		if chance < throttle_rate:
+			self._error(429, 'PER_SECOND_THRESHOLD', 'HTTP requests are more than allowed per second', {'Retry-After': str(retry_after)})
+			return False
+		if chance < throttle_rate + error_rate:
+			self._error(random.choice([500, 503]), 'GENERAL_ERROR', 'Internal server error.')
+			return False
+		return True
+
+	# The url items link back to, as Alma gives its own address.
+	def _root(self):
+		return 'http://' + self.headers.get('Host', '127.0.0.1:' + str(self.server.server_address[1])) + '/almaws/v1'
+
+	def _count(self, name):
+		with self.server.lock:
+			self.server.stats[name] += 1
+
+	def _error(self, code, error_code, message, headers={}):
+		self._count(self.command + ' ' + str(code))
+		self._send(code, '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+			'<web_service_result xmlns="http://com/exlibris/urm/general/xmlbeans">'
+			'<errorsExist>true</errorsExist><errorList><error>'
+			'<errorCode>' + error_code + '</errorCode>'
+			'<errorMessage>' + message + '</errorMessage>'
+			'</error></errorList></web_service_result>', headers=headers)
+
+	def _send(self, code, text, content_type='application/xml', headers={}):
+		body = text.encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', content_type + ';charset=UTF-8')
+		self.send_header('Content-Length', str(len(body)))
+		for (name, value) in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+# Draws how long a response should be held back.
+def _latency():
+	if latency <= 0:
+		return 0
+	if latency_distribution == 'uniform':
+		return random.uniform(0, 2*latency)
+	elif latency_distribution == 'exponential':
+		return random.expovariate(1/latency)
+	elif latency_distribution == 'lognormal':
+		# Chosen so that the average wait is still 'latency'.
+		return random.lognormvariate(math.log(latency) - latency_spread**2/2, latency_spread)
+	return latency
+
+"""_newItem(root, barcode)
+		Makes up an item record for a barcode, laid out as Alma's are, and
+		returns its (item id, xml). The ids are worked out from the barcode,
+		so the same barcode always gets the same item.
+"""
+def _newItem(root, barcode):
+	number = zlib.crc32(barcode.encode())
+	mms_id = '99' + str(number % 10**10).zfill(10) + '03941'
+	holding_id = '22' + str(number % 10**10).zfill(10) + '03941'
+	item_id = '23' + str(int(barcode) % 10**10).zfill(10) + '03941'
+	link = root + '/bibs/' + mms_id + '/holdings/' + holding_id
+	return (item_id, '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+		'<item link="' + link + '/items/' + item_id + '">'
+		'<bib_data link="' + root + '/bibs/' + mms_id + '">'
+			'<mms_id>' + mms_id + '</mms_id>'
+			'<title>Journal of Mock Studies ' + str(number % 1000) + '</title>'
+			'<issn>' + str(1000 + number % 9000) + '-' + str(1000 + number // 9000 % 9000) + '</issn>'
+			'<publisher_const>Example Press</publisher_const>'
+		'</bib_data>'
+		'<holding_data link="' + link + '">'
+			'<holding_id>' + holding_id + '</holding_id>'
+			'<call_number_type desc="Library of Congress classification">0</call_number_type>'
+			'<call_number>AP1 .M6</call_number>'
+		'</holding_data>'
+		'<item_data>'
+			'<pid>' + item_id + '</pid>'
+			'<barcode>' + barcode + '</barcode>'
+			'<creation_date>2015-06-01Z</creation_date>'
+			'<modification_date>2016-02-11Z</modification_date>'
+			'<base_status desc="Item in place">1</base_status>'
+			'<physical_material_type desc="Issue">ISSUE</physical_material_type>'
+			'<policy desc="general circulation">01</policy>'
+			'<provenance desc=""></provenance>'
+			'<po_line></po_line>'
+			'<is_magnetic>false</is_magnetic>'
+			'<enumeration_a></enumeration_a>'
+			'<enumeration_b></enumeration_b>'
+			'<chronology_i></chronology_i>'
+			'<chronology_j></chronology_j>'
+			'<description>v.' + str(number % 120) + '</description>'
+			'<library desc="Main Library">MAIN</library>'
+			'<location desc="Stacks">STACKS</location>'
+		'</item_data>'
+		'</item>')
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,101 @@
+"""Smoke tests for BatchUpdate.py
+		Runs a small made up Alma export through -f, -s, -p and -u against a
+		MockAlma server started for the tests, checking that every step gets
+		through the file and that the items reach the server. Run them with
+		'python -m unittest' (or pytest).
+"""
+
+import csv
+import os
+import tempfile
+import threading
+import unittest
+
+import BatchUpdate
+import MockAlma
+
+# A raw Alma export, as it comes out of Alma: barcodes not yet formatted, and
+# only some of the columns -s and -u use.
+export_header = ['title', 'MMS ID', 'Barcode', 'Description']
+export_rows = [['Journal of Things ' + str(title), '99000000000' + str(title) + '138', str(39581747781260 + 10*title + item), description]
+			   for title in range(3)
+			   for (item, description) in enumerate(['v.16 no.7 (Fall 1963)', 'v.58 no.2 (Aug 1965)', 'v.93 no.8 (Aug 66)', 'v.108 (1967)', 'index 1937'])]
+
+class SmokeTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.mock_settings = (MockAlma.port, MockAlma.latency, MockAlma.rate_limit)
+		(MockAlma.port, MockAlma.latency, MockAlma.rate_limit) = (0, 0.0, 0)
+		cls.server = MockAlma.start()
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+		(MockAlma.port, MockAlma.latency, MockAlma.rate_limit) = cls.mock_settings
+
+	# Every file (the caches and call count included) goes in a folder of its
+	# own, and the settings are put back afterwards.
+	def setUp(self):
+		self.folder = tempfile.TemporaryDirectory()
+		names = ('alma_api_url', 'item_cache_file', 'split_cache_file', 'call_count_file', 'quiet', 'metrics_report')
+		self.settings = {name: getattr(BatchUpdate, name) for name in names}
+		BatchUpdate.alma_api_url = MockAlma.apiUrl(self.server)
+		BatchUpdate.item_cache_file = self._path('item_cache.sqlite')
+		BatchUpdate.split_cache_file = self._path('split_cache.sqlite')
+		BatchUpdate.call_count_file = self._path('call_count.sqlite')
+		BatchUpdate.quiet = True
+		BatchUpdate.metrics_report = False
+
+		self.export = self._path('export.csv')
+		with open(self.export, 'w', newline='') as file:
+			writer = csv.writer(file)
+			writer.writerow(export_header)
+			writer.writerows(export_rows)
+
+	def tearDown(self):
+		for (name, value) in self.settings.items():
+			setattr(BatchUpdate, name, value)
+		self.folder.cleanup()
+
+	def _path(self, name):
+		return os.path.join(self.folder.name, name)
+
+	def _rows(self, name):
+		with open(self._path(name), newline='') as file:
+			return list(csv.DictReader(file))
+
+	def _requests(self, name):
+		with self.server.lock:
+			return self.server.stats[name]
+
+	def test_formatSplitPrefetchUpdate(self):
+		BatchUpdate._run(self.export, ['-f', '-s', '-p', '-u'], confirmed=True)
+
+		self.assertEqual(len(self._rows('f_export.csv')), len(export_rows))
+		split_rows = self._rows('s_export.csv')
+		self.assertEqual(len(split_rows), len(export_rows))
+		self.assertTrue(all(row['Pattern'] for row in split_rows))
+
+		updated = self._rows('suc_export.csv')
+		failed = self._rows('err_export.csv')
+		self.assertEqual(len(updated) + len(failed), len(export_rows))
+		self.assertTrue(updated)
+		self.assertTrue(all(row['Notes'].startswith(('Changed', 'Unchanged')) for row in updated))
+
+	# -p on an export that hasn't been formatted fetches nothing (its
+	# barcodes wouldn't pass -u's checks), but mustn't fall over on the
+	# columns the export lacks.
+	def test_prefetchRawExport(self):
+		before = self._requests('GET 200')
+		BatchUpdate.prefetch(self.export)
+		self.assertEqual(self._requests('GET 200'), before)
+
+		formatted = BatchUpdate.format(self.export)
+		BatchUpdate.prefetch(formatted)
+		self.assertEqual(self._requests('GET 200'), before + len(export_rows))
+
+if __name__ == '__main__':
+	unittest.main()